@@ -0,0 +1,476 @@
+"""
+Benchmark collect_chef_metadata.py against in-process stand-ins for the
+Chef Server API and the SignalFx dimension API
+
+Example:
+    python benchmark.py --nodes 100,1000,10000 --chef-latency 20 \\
+        --collection-mode partial-search --runs 3 --change-rate 0.01
+"""
+from pkg_resources import parse_version
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import requests
+import collect_chef_metadata
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+DEFAULT_NODES = '100,1000'
+DEFAULT_RUNS = 2
+DEFAULT_CHANGE_RATE = 0.01
+DEFAULT_PAYLOAD_SIZE = 20000
+BENCHMARK_CONFIG = ['roles', 'tags', 'platform', 'platform_version',
+                    'kernel.name', 'kernel.release', 'kernel.machine',
+                    'languages.python.version', 'languages.ruby.version',
+                    'cloud.provider', 'cloud.region']
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """
+    HTTP server running in a background thread, answering with JSON
+    after `latency` seconds and failing `error_rate` of the requests
+
+    Subclasses implement handle(method, path, query, body) and return a
+    tuple of (status code, JSON-serializable body)
+    """
+
+    error_status = 500
+
+    def __init__(self, latency=0, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, avoid waiting for
+            # delayed ACKs on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def do_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, data = server.dispatch(self.command, self.path, body)
+                payload = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                server.count(self.command, self.path,
+                             len(self.requestline) + length, len(payload))
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def count(self, method, path, bytes_in, bytes_out):
+        endpoint = method + ' ' + self.endpoint_name(urlparse(path).path)
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def endpoint_name(self, path):
+        return path
+
+    def dispatch(self, method, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status, {'error': 'injected failure'}
+        url = urlparse(path)
+        query = dict((key, values[0])
+                     for key, values in parse_qs(url.query).items())
+        data = json.loads(body.decode('utf-8')) if body else None
+        return self.handle(method, url.path, query, data)
+
+
+class FakeChefServer(FakeServer):
+    """
+    Stand-in for the Chef Server API of an organization with `fleet_size`
+    nodes, each carrying about `payload_size` bytes of ohai data
+    """
+
+    def __init__(self, fleet_size, payload_size=DEFAULT_PAYLOAD_SIZE,
+                 organization='benchmark', **kwargs):
+        self.fleet_size = fleet_size
+        self.organization = organization
+        self.payload_size = payload_size
+        self.node_names = ['node%06d.example.com' % i
+                           for i in range(fleet_size)]
+        self.node_set = set(self.node_names)
+        # node name -> number of times the node converged since the start
+        self.generations = {}
+        FakeServer.__init__(self, **kwargs)
+
+    def converge(self, count):
+        """
+        Simulate a Chef client run changing `count` random nodes
+        """
+        for node_name in random.sample(self.node_names, count):
+            self.generations[node_name] = \
+                self.generations.get(node_name, 0) + 1
+
+    def node(self, node_name):
+        generation = self.generations.get(node_name, 0)
+        index = int(node_name[4:10])
+        return {
+            'name': node_name,
+            'chef_environment': ('production', 'staging')[index % 2],
+            'automatic': {
+                'ohai_time': 1400000000 + generation,
+                'roles': ['web', 'cache'] if index % 3 else ['db'],
+                'platform': 'ubuntu',
+                'platform_version': '14.04',
+                'kernel': {'name': 'Linux', 'machine': 'x86_64',
+                           'release': '3.13.0-%d-generic' % generation},
+                'languages': {'python': {'version': '2.7.6'},
+                              'ruby': {'version': '2.1.%d' % (index % 4)}},
+                'cloud': {'provider': 'ec2', 'region': 'us-west-2'},
+                'ohai_padding': 'x' * self.payload_size,
+            },
+            'normal': {'tags': ['benchmark']},
+            'default': {},
+            'override': {},
+        }
+
+    def merged_attributes(self, node_name):
+        node = self.node(node_name)
+        attributes = {}
+        for precedence in ('default', 'normal', 'override', 'automatic'):
+            attributes.update(node[precedence])
+        attributes['name'] = node_name
+        attributes['chef_environment'] = node['chef_environment']
+        return attributes
+
+    def endpoint_name(self, path):
+        if path.startswith('/nodes/'):
+            return '/nodes/<name>'
+        return path
+
+    def handle(self, method, path, query, data):
+        if path in ('', '/'):
+            return 200, {'name': self.organization}
+        if path == '/nodes':
+            return 200, dict((node_name, '/nodes/' + node_name)
+                             for node_name in self.node_names)
+        if path.startswith('/nodes/'):
+            node_name = path[len('/nodes/'):]
+            if node_name not in self.node_set:
+                return 404, {'error': ['not found']}
+            return 200, self.node(node_name)
+        if path == '/search/node' and method == 'POST':
+            start = int(query.get('start', 0))
+            rows = int(query.get('rows', 1000))
+            results = []
+            for node_name in self.node_names[start:start + rows]:
+                attributes = self.merged_attributes(node_name)
+                row = {}
+                for key, key_path in data.items():
+                    value = attributes
+                    for token in key_path:
+                        value = value.get(token) \
+                            if isinstance(value, dict) else None
+                    row[key] = value
+                results.append({'url': '/nodes/' + node_name, 'data': row})
+            return 200, {'total': self.fleet_size, 'start': start,
+                         'rows': results}
+        return 404, {'error': ['not found']}
+
+
+class FakeSignalFxServer(FakeServer):
+    """
+    Stand-in for the SignalFx v1 and v2 dimension APIs, where every
+    chefUniqueId has a dimension
+    """
+
+    error_status = 503
+
+    def endpoint_name(self, path):
+        if path.startswith('/v1/dimension/'):
+            return '/v1/dimension/<id>'
+        if path.startswith('/v2/dimension/chefUniqueId/'):
+            return '/v2/dimension/chefUniqueId/<value>/_/sfxagent'
+        return path
+
+    @staticmethod
+    def objectid(unique_id):
+        return hashlib.md5(unique_id.encode('utf-8')).hexdigest()[:11]
+
+    def handle(self, method, path, query, data):
+        if path == '/v1/dimension' and method == 'GET':
+            value = query['query'][len('chefUniqueId:'):]
+            if query.get('getIDs') == 'true':
+                return 200, {'rs': [self.objectid(value)], 'count': 1}
+            unique_ids = [unique_id.replace('\\', '') for unique_id
+                          in value.strip('()').split(' OR ')]
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 100))
+            results = [{'chefUniqueId': unique_id,
+                        'sf_id': self.objectid(unique_id)}
+                       for unique_id in unique_ids]
+            return 200, {'rs': results[offset:offset + limit],
+                         'count': len(results)}
+        if path.startswith('/v1/dimension/'):
+            return 200, {}
+        if path.startswith('/v2/dimension/chefUniqueId/') and \
+                path.endswith('/_/sfxagent') and method == 'PATCH':
+            return 200, data
+        return 404, {}
+
+
+class BenchChefAPI(object):
+    """
+    Stand-in for chef.ChefAPI talking to the fake Chef server over HTTP
+    Requests are not signed, so the signing cost is not measured
+    """
+
+    version = '0.10.8'
+
+    def __init__(self, url):
+        self.url = url
+        self.version_parsed = parse_version(self.version)
+        self.platform = False
+        self.session = requests.Session()
+
+    def api_request(self, method, path, headers={}, data=None):
+        if data is not None:
+            data = json.dumps(data)
+        resp = self.session.request(
+            method, self.url + path, data=data,
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'application/json'})
+        resp.raise_for_status()
+        return resp.json()
+
+    def __getitem__(self, path):
+        return self.api_request('GET', path)
+
+
+def peak_rss_mb():
+    """
+    return: peak resident set size of this process in MB, which includes
+    the fake servers and never goes down, see run_isolated()
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+
+def run_benchmark(fleet_size, runs=DEFAULT_RUNS,
+                  change_rate=DEFAULT_CHANGE_RATE,
+                  payload_size=DEFAULT_PAYLOAD_SIZE, chef_latency=0,
+                  signalfx_latency=0, chef_error_rate=0,
+                  signalfx_error_rate=0, **options):
+    """
+    Run `runs` sweeps of ChefMetadata over a fake fleet, converging
+    `change_rate` of the nodes between sweeps. The options are passed to
+    ChefMetadata.
+    A sweep stopped by an error, such as an injected Chef error on the
+    listing, is recorded with the error instead of ending the benchmark
+
+    return: list of dictionaries of measurements, one per sweep
+    """
+    directory = tempfile.mkdtemp()
+    config_file = os.path.join(directory, 'configuration.txt')
+    with open(config_file, 'w') as f:
+        f.write('\n'.join(BENCHMARK_CONFIG) + '\n')
+    chef = FakeChefServer(fleet_size, payload_size=payload_size,
+                          latency=chef_latency, error_rate=chef_error_rate)
+    signalfx = FakeSignalFxServer(latency=signalfx_latency,
+                                  error_rate=signalfx_error_rate)
+    options.setdefault('SIGNALFX_RATE_LIMIT', 0)
+    m = collect_chef_metadata.ChefMetadata(
+        SIGNALFX_API_TOKEN='benchmark',
+        CONFIG_FILE=config_file,
+        SIGNALFX_REST_API=signalfx.url,
+        STATE_FILE=os.path.join(directory, 'state.db'),
+        PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'),
+        LOG_HANDLER='stdout',
+        **options)
+    m.logger.setLevel(logging.WARNING)
+    m.api = BenchChefAPI(chef.url)
+    results = []
+    try:
+        for sweep in range(runs):
+            if sweep > 0:
+                chef.converge(int(fleet_size * change_rate))
+            chef.reset_counters()
+            signalfx.reset_counters()
+            started = time.time()
+            error = None
+            try:
+                m.run()
+            except (SystemExit, Exception) as e:
+                error = type(e).__name__ + ': ' + str(e)
+            results.append({
+                'nodes': fleet_size,
+                'sweep': sweep + 1,
+                'seconds': time.time() - started,
+                'chef_requests': sum(chef.requests.values()),
+                'signalfx_requests': sum(signalfx.requests.values()),
+                'requests': dict(list(chef.requests.items()) +
+                                 list(signalfx.requests.items())),
+                'bytes': chef.bytes_in + chef.bytes_out +
+                signalfx.bytes_in + signalfx.bytes_out,
+                'peak_rss_mb': peak_rss_mb(),
+                'phases': m.telemetry.snapshot()['phases'],
+                'counters': m.telemetry.snapshot()['counters'],
+                'error': error,
+            })
+    finally:
+        m.logger.removeHandler(m.handler)
+        m.state.close()
+        chef.stop()
+        signalfx.stop()
+        shutil.rmtree(directory)
+    return results
+
+
+def run_isolated(fleet_size, **options):
+    """
+    Run run_benchmark() in a child process, so that the peak memory
+    measured is the one of this fleet size alone
+
+    return: list of dictionaries of measurements, one per sweep
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_benchmark, (fleet_size,), options)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def format_results(results):
+    """
+    return: the measurements as a text table
+    """
+    lines = ['%8s %6s %10s %10s %10s %12s %10s  %s' % (
+        'nodes', 'sweep', 'seconds', 'chef_reqs', 'sfx_reqs', 'MB_moved',
+        'peak_MB', 'error')]
+    for result in results:
+        lines.append('%8d %6d %10.2f %10d %10d %12.2f %10.1f  %s' % (
+            result['nodes'], result['sweep'], result['seconds'],
+            result['chef_requests'], result['signalfx_requests'],
+            result['bytes'] / 1024.0 / 1024.0, result['peak_rss_mb'],
+            result['error'] or '-'))
+    return '\n'.join(lines)
+
+
+def get_argument_parser():
+    """
+    Create a parser object and initialize it
+
+    return: argparse.ArgumentParser() object
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the ' +
+                                     'collection of Chef metadata against ' +
+                                     'fake Chef and SignalFx servers.')
+    parser.add_argument('--nodes', default=DEFAULT_NODES,
+                        help='Comma separated fleet sizes. ' +
+                        'Default is ' + DEFAULT_NODES)
+    parser.add_argument('--runs', default=DEFAULT_RUNS, type=int,
+                        help='Sweeps per fleet size. ' +
+                        'Default is ' + str(DEFAULT_RUNS))
+    parser.add_argument('--change-rate', default=DEFAULT_CHANGE_RATE,
+                        type=float, help='Fraction of the nodes ' +
+                        'converging between sweeps. ' +
+                        'Default is ' + str(DEFAULT_CHANGE_RATE))
+    parser.add_argument('--payload-size', default=DEFAULT_PAYLOAD_SIZE,
+                        type=int, help='Bytes of ohai data per node. ' +
+                        'Default is ' + str(DEFAULT_PAYLOAD_SIZE))
+    parser.add_argument('--chef-latency', default=0, type=float,
+                        help='Chef Server API latency in milliseconds')
+    parser.add_argument('--signalfx-latency', default=0, type=float,
+                        help='SignalFx API latency in milliseconds')
+    parser.add_argument('--chef-error-rate', default=0, type=float,
+                        help='Fraction of failing Chef Server API requests')
+    parser.add_argument('--signalfx-error-rate', default=0, type=float,
+                        help='Fraction of failing SignalFx API requests')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='Print the measurements as JSON')
+    parser.add_argument('--collection-mode', dest='COLLECTION_MODE',
+                        default=collect_chef_metadata.DEFAULT_COLLECTION_MODE,
+                        choices=('nodes', 'partial-search'))
+    parser.add_argument('--chef-concurrency', dest='CHEF_CONCURRENCY',
+                        default=collect_chef_metadata.DEFAULT_CHEF_CONCURRENCY,
+                        type=int)
+    parser.add_argument('--run-mode', dest='RUN_MODE',
+                        default=collect_chef_metadata.DEFAULT_RUN_MODE,
+                        choices=('batch', 'pipeline'))
+    parser.add_argument('--incremental', dest='INCREMENTAL',
+                        action='store_true', default=False)
+    parser.add_argument('--signalfx-concurrency',
+                        dest='SIGNALFX_CONCURRENCY',
+                        default=collect_chef_metadata
+                        .DEFAULT_SIGNALFX_CONCURRENCY, type=int)
+    parser.add_argument('--update-mode', dest='UPDATE_MODE',
+                        default=collect_chef_metadata.DEFAULT_UPDATE_MODE,
+                        choices=('params', 'json'))
+    return parser
+
+
+def main(argv):
+    """
+    Parse command line arguments and run the benchmark
+    """
+    args = vars(get_argument_parser().parse_args(argv))
+    fleet_sizes = [int(size) for size in args.pop('nodes').split(',')]
+    as_json = args.pop('json')
+    args['chef_latency'] /= 1000.0
+    args['signalfx_latency'] /= 1000.0
+    results = []
+    for fleet_size in fleet_sizes:
+        results.extend(run_isolated(fleet_size, **args))
+    if as_json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
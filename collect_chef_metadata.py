@@ -1,21 +1,73 @@
-from chef import autoconfigure, Node
+from chef import autoconfigure, ChefAPI, Node
+from multiprocessing.pool import ThreadPool
+from node_metadata import ExtractionPlan, ValueInterner
+from notify_server import NotificationServer
+from pipeline import Pipeline, Stage
+from profiler import NodeProfiler
+from scheduler import AdaptiveScheduler
+from sharding import shard_of
+from state_store import ObjectIdCache, RunLock, StateStore
 from time import sleep
+from signalfx_client import SignalFxClient, SignalFxError
+from telemetry import Telemetry
+import cProfile
 import logging
+import threading
+import time
 import sys
-import requests
-import copy
+import hashlib
+import json
 import re
-import pickle
 import os
 import argparse
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+try:
+    from urllib.parse import quote, urlparse
+except ImportError:
+    from urllib import quote
+    from urlparse import urlparse
 
 DEFAULT_CONFIG_FILE = 'configuration.txt'
 DEFAULT_LOG_FILE = '/tmp/ChefMetadata.log'
 DEFAULT_SIGNALFX_REST_API = 'https://api.signalfx.com'
+DEFAULT_SIGNALFX_INGEST_API = 'https://ingest.signalfx.com'
 DEFAULT_PICKLE_FILE = 'pk_metadata.pk'
+DEFAULT_STATE_FILE = 'chef_metadata_state.db'
+DEFAULT_OBJECTID_TTL = 86400
+DEFAULT_OBJECTID_NEGATIVE_TTL = 600
+DEFAULT_OBJECTID_CACHE_SIZE = 100000
+DEFAULT_OBJECTID_BATCH_SIZE = 100
+MAX_OBJECTID_QUERY_LENGTH = 4000
 DEFAULT_SLEEP_DURATION = 60
 DEFAULT_ENV_VARIABLE_NAME = 'SIGNALFX_API_TOKEN'
 DEFAULT_LOG_HANDLER = 'logfile'
+DEFAULT_COLLECTION_MODE = 'nodes'
+DEFAULT_SEARCH_ROWS = 1000
+DEFAULT_CHEF_CONCURRENCY = 1
+DEFAULT_RUN_MODE = 'batch'
+DEFAULT_PIPELINE_QUEUE_SIZE = 1000
+DEFAULT_MAX_INTERVAL = 3600
+DEFAULT_SHARD_INDEX = 0
+DEFAULT_SHARD_COUNT = 1
+FINGERPRINT_SEARCH_KEYS = {
+    'name': ['name'],
+    'chef_environment': ['chef_environment'],
+    'ohai_time': ['ohai_time'],
+}
+DEFAULT_SIGNALFX_RATE_LIMIT = 20
+DEFAULT_SIGNALFX_MAX_RETRIES = 5
+DEFAULT_SIGNALFX_CONCURRENCY = 10
+DEFAULT_UPDATE_MODE = 'params'
+DEFAULT_NOTIFY_ADDRESS = '127.0.0.1'
+SWEEP_CURSOR = 'sweep'
+DEFAULT_PROFILE_TOP = 10
 
 
 class ChefMetadata(object):
@@ -30,14 +82,69 @@ class ChefMetadata(object):
                  SIGNALFX_REST_API=DEFAULT_SIGNALFX_REST_API,
                  PICKLE_FILE=DEFAULT_PICKLE_FILE,
                  SLEEP_DURATION=DEFAULT_SLEEP_DURATION,
-                 LOG_HANDLER=DEFAULT_LOG_HANDLER):
-        self.api = autoconfigure()
+                 LOG_HANDLER=DEFAULT_LOG_HANDLER,
+                 COLLECTION_MODE=DEFAULT_COLLECTION_MODE,
+                 SEARCH_ROWS=DEFAULT_SEARCH_ROWS,
+                 CHEF_CONCURRENCY=DEFAULT_CHEF_CONCURRENCY,
+                 STATE_FILE=DEFAULT_STATE_FILE,
+                 OBJECTID_TTL=DEFAULT_OBJECTID_TTL,
+                 OBJECTID_NEGATIVE_TTL=DEFAULT_OBJECTID_NEGATIVE_TTL,
+                 OBJECTID_CACHE_SIZE=DEFAULT_OBJECTID_CACHE_SIZE,
+                 OBJECTID_BATCH_SIZE=DEFAULT_OBJECTID_BATCH_SIZE,
+                 SIGNALFX_RATE_LIMIT=DEFAULT_SIGNALFX_RATE_LIMIT,
+                 SIGNALFX_MAX_RETRIES=DEFAULT_SIGNALFX_MAX_RETRIES,
+                 RUN_MODE=DEFAULT_RUN_MODE,
+                 PIPELINE_QUEUE_SIZE=DEFAULT_PIPELINE_QUEUE_SIZE,
+                 INCREMENTAL=False,
+                 TELEMETRY=False,
+                 SIGNALFX_INGEST_API=DEFAULT_SIGNALFX_INGEST_API,
+                 STATS_FILE=None,
+                 SHARD_INDEX=DEFAULT_SHARD_INDEX,
+                 SHARD_COUNT=DEFAULT_SHARD_COUNT,
+                 MAX_INTERVAL=DEFAULT_MAX_INTERVAL,
+                 CHEF_CONFIG=None,
+                 SIGNALFX_CONCURRENCY=DEFAULT_SIGNALFX_CONCURRENCY,
+                 UPDATE_MODE=DEFAULT_UPDATE_MODE,
+                 NOTIFY_PORT=None,
+                 NOTIFY_ADDRESS=DEFAULT_NOTIFY_ADDRESS,
+                 TIME_BUDGET=None,
+                 PROFILE=None,
+                 PROFILE_TOP=DEFAULT_PROFILE_TOP):
         self.SIGNALFX_API_TOKEN = SIGNALFX_API_TOKEN
         self.CONFIG_FILE = CONFIG_FILE
         self.LOG_FILE = LOG_FILE
         self.SIGNALFX_REST_API = SIGNALFX_REST_API + '/v1/dimension'
+        self.SIGNALFX_DIMENSION_API = SIGNALFX_REST_API + \
+            '/v2/dimension/chefUniqueId/'
         self.PICKLE_FILE = PICKLE_FILE
         self.SLEEP_DURATION = SLEEP_DURATION
+        self.COLLECTION_MODE = COLLECTION_MODE
+        self.SEARCH_ROWS = SEARCH_ROWS
+        self.CHEF_CONCURRENCY = CHEF_CONCURRENCY
+        self.STATE_FILE = STATE_FILE
+        self.OBJECTID_TTL = OBJECTID_TTL
+        self.OBJECTID_NEGATIVE_TTL = OBJECTID_NEGATIVE_TTL
+        self.OBJECTID_CACHE_SIZE = OBJECTID_CACHE_SIZE
+        self.OBJECTID_BATCH_SIZE = OBJECTID_BATCH_SIZE
+        self.SIGNALFX_RATE_LIMIT = SIGNALFX_RATE_LIMIT
+        self.SIGNALFX_MAX_RETRIES = SIGNALFX_MAX_RETRIES
+        self.RUN_MODE = RUN_MODE
+        self.PIPELINE_QUEUE_SIZE = PIPELINE_QUEUE_SIZE
+        self.INCREMENTAL = INCREMENTAL
+        self.TELEMETRY = TELEMETRY
+        self.SIGNALFX_INGEST_API = SIGNALFX_INGEST_API + '/v2/datapoint'
+        self.STATS_FILE = STATS_FILE
+        self.SHARD_INDEX = SHARD_INDEX
+        self.SHARD_COUNT = SHARD_COUNT
+        self.MAX_INTERVAL = MAX_INTERVAL
+        self.CHEF_CONFIG = CHEF_CONFIG
+        self.SIGNALFX_CONCURRENCY = SIGNALFX_CONCURRENCY
+        self.UPDATE_MODE = UPDATE_MODE
+        self.NOTIFY_PORT = NOTIFY_PORT
+        self.NOTIFY_ADDRESS = NOTIFY_ADDRESS
+        self.TIME_BUDGET = TIME_BUDGET
+        self.PROFILE = PROFILE
+        self.PROFILE_TOP = PROFILE_TOP
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
@@ -51,10 +158,35 @@ class ChefMetadata(object):
         self.handler.setFormatter(self.formatter)
         self.logger.addHandler(self.handler)
 
+        self.api = self.get_chef_api(CHEF_CONFIG)
+
+        self.signalfx = SignalFxClient(SIGNALFX_API_TOKEN,
+                                       pool_size=max(CHEF_CONCURRENCY,
+                                                     SIGNALFX_CONCURRENCY,
+                                                     10),
+                                       rate_limit=SIGNALFX_RATE_LIMIT,
+                                       max_retries=SIGNALFX_MAX_RETRIES,
+                                       logger=self.logger,
+                                       observer=self.observe_signalfx_request)
+
         self.property_name_pattern = re.compile('^[a-zA-Z_][a-zA-Z0-9_-]*$')
+        self.query_special_characters = re.compile(
+            r'([+\-!(){}\[\]^"~*?:\\/&|\s])')
         self.config = []
+        self.config_mtime = None
+        self.extraction_plan = None
+        self.interner = ValueInterner()
         self.organization = ''
         self.nodes_metadata = []
+        self.unsent_ids = set()
+        self.listed_ids = set()
+        self.fingerprints = {}
+        self.saved_fingerprints = {}
+        self.state = None
+        self.objectids = None
+        self.telemetry = Telemetry()
+        self.profiler = NodeProfiler(enabled=bool(PROFILE), top=PROFILE_TOP)
+        self.notifications = queue.Queue()
 
     def run(self):
         """
@@ -62,99 +194,804 @@ class ChefMetadata(object):
         Collect metadata from Chef Server API
         Send metadata to Signalfx
         Save the metadata for future comparisions
+        Report how the run went
+        Profile the run if PROFILE is set
+        """
+        if self.PROFILE:
+            self.run_profiled()
+            return
+        self.run_sweep()
+
+    def run_profiled(self):
+        """
+        Run a sweep under cProfile, write the profile to PROFILE and log
+        and print the PROFILE_TOP slowest nodes and calls and largest nodes
+
+        cProfile only sees the calling thread, use the batch run mode with
+        a CHEF_CONCURRENCY and SIGNALFX_CONCURRENCY of 1 for a complete
+        profile. The node timings cover all the threads
+        """
+        self.profiler.reset()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            self.run_sweep()
+        finally:
+            profile.disable()
+            try:
+                profile.dump_stats(self.PROFILE)
+            except Exception:
+                self.logger.error('Unable to write ' + self.PROFILE,
+                                  exc_info=True)
+            report = self.profiler.report()
+            self.logger.info('Profile written to ' + self.PROFILE + '\n' +
+                             report)
+            if getattr(self.handler, 'stream', None) is not sys.stdout:
+                print(report)
+
+    def run_sweep(self):
+        """
+        Run a sweep in the configured run mode and report its telemetry
+        """
+        self.telemetry.start_sweep()
+        try:
+            if self.TIME_BUDGET:
+                self.run_budgeted()
+            elif self.RUN_MODE == 'pipeline':
+                self.run_pipeline()
+            else:
+                self.run_batch()
+        finally:
+            self.telemetry.end_sweep()
+            self.report_telemetry()
+
+    def run_batch(self):
+        """
+        Run the steps of run() one after the other over all nodes
+        """
+        self.start_sweep()
+        with self.telemetry.phase('collect'):
+            self.collect_metadata_from_chef()
+        with self.telemetry.phase('send'):
+            self.send_all_metadata_to_signalfx()
+        with self.telemetry.phase('save'):
+            self.save_metadata()
+        self.telemetry.increment('nodes.listed', len(self.listed_ids))
+        self.telemetry.increment('nodes.collected',
+                                 len(self.nodes_metadata))
+
+    def run_budgeted(self):
+        """
+        Sync the nodes OBJECTID_BATCH_SIZE at a time, saving each chunk,
+        until all nodes are synced or TIME_BUDGET seconds have passed
+        The nodes are taken in the order of their names, starting after
+        the last node synced by the previous run, so that a fleet which
+        takes longer than the budget is covered over several runs
+        """
+        deadline = time.time() + self.TIME_BUDGET
+        self.start_sweep()
+        with self.telemetry.phase('list'):
+            organization_details = self.chef_api_get_request('')
+            self.organization = organization_details['name']
+            items = sorted(self.list_nodes(), key=self.get_item_name)
+        self.state.delete(self.state.unique_ids() - self.listed_ids)
+        self.telemetry.increment('nodes.listed', len(self.listed_ids))
+        cursor = self.state.get_cursor(SWEEP_CURSOR)
+        if cursor is not None:
+            start = 0
+            while start < len(items) and \
+                    self.get_item_name(items[start]) <= cursor:
+                start += 1
+            items = items[start:] + items[:start]
+        synced = 0
+        with self.telemetry.phase('sync'):
+            while synced < len(items) and time.time() < deadline:
+                chunk = items[synced:synced + self.OBJECTID_BATCH_SIZE]
+                self.sync_nodes(chunk)
+                synced += len(chunk)
+                self.state.set_cursor(SWEEP_CURSOR,
+                                      self.get_item_name(chunk[-1]))
+        self.telemetry.increment('nodes.deferred', len(items) - synced)
+        if synced < len(items):
+            self.logger.warning('Time budget of ' + str(self.TIME_BUDGET) +
+                                ' seconds spent, ' +
+                                str(len(items) - synced) + ' of ' +
+                                str(len(items)) + ' nodes are left for ' +
+                                'the next run')
+
+    def get_item_name(self, item):
+        """
+        return: the node name of an item listed by list_nodes()
+        """
+        if isinstance(item, Mapping):
+            return item['name']
+        return item
+
+    def run_pipeline(self):
+        """
+        Run the same steps as run() as a pipeline of concurrent stages,
+        so that a node is sent to Signalfx and saved as soon as it is
+        collected, without keeping the metadata of all nodes in memory
+        """
+        self.start_sweep()
+        organization_details = self.chef_api_get_request('')
+        self.organization = organization_details['name']
+        headers = {
+            'X-SF-Token': self.SIGNALFX_API_TOKEN,
+        }
+        collected_ids = set()
+
+        def extract(item, emit):
+            if self.COLLECTION_MODE == 'partial-search':
+                emit(self.build_node_information_from_search(item))
+            else:
+                emit(self.fetch_node_information(item))
+
+        def diff(node_information, emit):
+            collected_ids.add(node_information['chefUniqueId'])
+            new_metadata = self.check_for_updates_in_metadata(
+                node_information)
+            self.count_update(new_metadata)
+            emit((node_information, new_metadata))
+
+        def resolve(updates, emit):
+            if self.UPDATE_MODE == 'params':
+                self.prefetch_signalfx_objectids(
+                    [node_information['chefUniqueId']
+                     for node_information, new_metadata in updates
+                     if new_metadata], headers)
+            for update in updates:
+                emit(update)
+
+        def send(update, emit):
+            node_information, new_metadata = update
+            if not new_metadata:
+                self.logger.info('No new metadata is found for ' +
+                                 node_information['chefUniqueId'])
+                emit(node_information)
+            elif self.send_update_to_signalfx(node_information,
+                                              new_metadata, headers):
+                emit(node_information)
+            else:
+                self.telemetry.increment('nodes.unsent')
+
+        def commit(nodes_metadata, emit):
+            self.state.commit(nodes_metadata, self.fingerprints)
+
+        pipeline = Pipeline([
+            Stage('extract', extract, workers=self.CHEF_CONCURRENCY),
+            Stage('diff', diff),
+            Stage('resolve', resolve, batch_size=self.OBJECTID_BATCH_SIZE),
+            Stage('send', send, workers=self.SIGNALFX_CONCURRENCY),
+            Stage('commit', commit, batch_size=self.OBJECTID_BATCH_SIZE),
+        ], self.logger, queue_size=self.PIPELINE_QUEUE_SIZE)
+        with self.telemetry.phase('pipeline'):
+            pipeline.run(self.list_nodes())
+        with self.telemetry.phase('save'):
+            self.state.delete(self.state.unique_ids() - self.listed_ids)
+            self.objectids.flush()
+        self.telemetry.increment('nodes.listed', len(self.listed_ids))
+        self.telemetry.increment('nodes.collected', len(collected_ids))
+        self.logger.info('Synced metadata of ' + str(len(collected_ids)) +
+                         ' of ' + str(len(self.listed_ids)) +
+                         ' nodes to ' + self.STATE_FILE)
+
+    def run_adaptive(self):
+        """
+        Run forever, syncing each node when the scheduler says it is due
+        instead of syncing all nodes every SLEEP_DURATION
+        """
+        scheduler = AdaptiveScheduler(self.SLEEP_DURATION, self.MAX_INTERVAL)
+        while True:
+            self.run_scheduled(scheduler)
+
+    def run_scheduled(self, scheduler):
+        """
+        List the nodes, then sync the nodes which are due, OBJECTID_BATCH_SIZE
+        at a time, until SLEEP_DURATION has passed
+        In the partial-search collection mode, the nodes are synced from the
+        data returned by the listing, without downloading the node objects
+        Nodes which changed, converged (in incremental mode) or could not
+        be synced are revisited sooner than the stable ones
+        """
+        self.telemetry.start_sweep()
+        try:
+            period_end = scheduler.clock() + self.SLEEP_DURATION
+            self.start_sweep()
+            with self.telemetry.phase('list'):
+                organization_details = self.chef_api_get_request('')
+                self.organization = organization_details['name']
+                search_rows = {}
+                converged = [self.get_item_name(item)
+                             for item in self.list_nodes(search_rows)]
+            prefix_length = len(self.organization) + 1
+            scheduler.update([unique_id[prefix_length:]
+                              for unique_id in self.listed_ids],
+                             converged if self.INCREMENTAL else ())
+            self.state.delete(self.state.unique_ids() - self.listed_ids)
+            self.telemetry.increment('nodes.listed', len(self.listed_ids))
+            while scheduler.clock() < period_end:
+                node_names = scheduler.pop_due(self.OBJECTID_BATCH_SIZE)
+                if not node_names:
+                    next_due = scheduler.next_due()
+                    if next_due is None or next_due > period_end:
+                        next_due = period_end
+                    sleep(max(next_due - scheduler.clock(), 0))
+                    continue
+                revisit_ids = set(self.organization + '_' + node_name
+                                  for node_name in node_names)
+                try:
+                    with self.telemetry.phase('sync'):
+                        revisit_ids = self.sync_nodes(
+                            [search_rows.get(node_name, node_name)
+                             for node_name in node_names])
+                finally:
+                    for node_name in node_names:
+                        scheduler.reschedule(
+                            node_name,
+                            self.organization + '_' + node_name in revisit_ids)
+        finally:
+            self.telemetry.end_sweep()
+            self.report_telemetry()
+
+    def sync_nodes(self, items):
+        """
+        Collect, send and save the metadata of the given nodes, listed by
+        list_nodes(), without removing the nodes which are gone
+
+        return: set of the chefUniqueIds of the nodes which changed or could
+        not be collected or sent
         """
         self.nodes_metadata = []
+        self.unsent_ids = set()
+        node_names = [self.get_item_name(item) for item in items]
+        if items and isinstance(items[0], Mapping):
+            for node_data in items:
+                self.get_node_information_from_search(node_data)
+        elif self.CHEF_CONCURRENCY > 1:
+            self.collect_node_information_concurrently(node_names)
+        else:
+            for node_name in node_names:
+                node_information = self.try_fetch_node_information(node_name)
+                if node_information is not None:
+                    self.nodes_metadata.append(node_information)
+        self.telemetry.increment('nodes.collected', len(self.nodes_metadata))
+        revisit_ids = set(self.organization + '_' + node_name
+                          for node_name in node_names)
+        revisit_ids -= set(node_information['chefUniqueId']
+                           for node_information in self.nodes_metadata)
+        revisit_ids.update(self.send_all_metadata_to_signalfx())
+        self.save_metadata(prune=False)
+        return revisit_ids
+
+    def run_daemon(self):
+        """
+        Run forever, syncing a node as soon as a notification that it
+        converged arrives on NOTIFY_PORT, while the sweeps of RUN_MODE
+        keep reconciling all nodes in the background
+        """
+        self.prepare_notifications()
+        server = NotificationServer(self.NOTIFY_ADDRESS, self.NOTIFY_PORT,
+                                    self.accept_notification, self.logger)
+        server.start()
+        self.logger.info('Listening for notifications on ' +
+                         self.NOTIFY_ADDRESS + ':' + str(server.port))
+        self.serve_notifications()
+
+    def prepare_notifications(self):
+        """
+        Get the organization name, open the state store and read the
+        configuration file, which the notified nodes need before the first
+        sweep is done
+        """
+        if not self.organization:
+            organization_details = self.chef_api_get_request('')
+            self.organization = organization_details['name']
+        self.open_state_store()
         self.read_config()
-        self.collect_metadata_from_chef()
-        for node_information in self.nodes_metadata:
-            self.send_metadata_to_signalfx(node_information)
-        self.save_metadata()
 
-    def save_metadata(self):
+    def accept_notification(self, node_name, organization):
         """
-        Save the metadata as Python pickle
+        Queue a notified node for syncing
+
+        return: False if the node belongs to another organization or shard
+        """
+        if organization and organization != self.organization:
+            return False
+        if not self.owns_node(node_name):
+            return False
+        self.notifications.put(node_name)
+        return True
+
+    def serve_notifications(self):
+        """
+        Sync the notified nodes, coalescing the notifications of a node
+        which arrive while it waits, and run the reconciliation sweeps in
+        a background thread
+        Exit if the sweeps stop on an error
+        """
+        self.prepare_notifications()
+        sweeper = threading.Thread(target=self.reconcile,
+                                   name='reconciliation')
+        sweeper.daemon = True
+        sweeper.start()
+        while sweeper.is_alive():
+            try:
+                node_names = set([self.notifications.get(timeout=1)])
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    node_names.add(self.notifications.get_nowait())
+                except queue.Empty:
+                    break
+            self.sync_notified_nodes(node_names)
+        self.exit_now()
+
+    def sync_notified_nodes(self, node_names):
+        """
+        Sync the given notified nodes one after the other, logging the
+        error of a node which cannot be synced and going on with the next
         """
-        pickle_data = {}
+        for node_name in sorted(node_names):
+            try:
+                self.sync_notified_node(node_name)
+            except Exception:
+                self.logger.error('Unable to sync notified node ' +
+                                  str(node_name), exc_info=True)
+
+    def reconcile(self):
+        """
+        Run the sweeps of RUN_MODE forever, without profiling them
+        """
+        if self.RUN_MODE == 'adaptive':
+            self.run_adaptive()
+            return
+        while True:
+            self.run_sweep()
+            sleep(self.SLEEP_DURATION)
+
+    def sync_notified_node(self, node_name):
+        """
+        Collect, send and save the metadata of a single node, without
+        touching the state of the sweep running in the background
+        """
+        self.telemetry.increment('nodes.notified')
+        node_information = self.try_fetch_node_information(node_name)
+        if node_information is None:
+            return
+        if self.send_metadata_to_signalfx(node_information):
+            self.state.commit([node_information])
+        else:
+            self.telemetry.increment('nodes.unsent')
+
+    def start_sweep(self):
+        """
+        Reset the results of the previous run, open the state store and
+        read the configuration file
+        """
+        self.nodes_metadata = []
+        self.unsent_ids = set()
+        self.listed_ids = set()
+        self.fingerprints = {}
+        self.interner = ValueInterner()
+        self.open_state_store()
+        with self.telemetry.phase('read_config'):
+            self.read_config()
+        if self.INCREMENTAL:
+            self.saved_fingerprints = self.state.fingerprints()
+
+    def open_state_store(self):
+        """
+        Open the state store once, importing the pickle file written by
+        earlier versions if the store is still empty
+        """
+        if self.state is not None:
+            return
+        self.state = StateStore(self.STATE_FILE)
+        # The ObjectID cache is set beforehand when shared by organizations
+        if self.objectids is None:
+            self.objectids = ObjectIdCache(self.state, self.OBJECTID_TTL,
+                                           self.OBJECTID_NEGATIVE_TTL,
+                                           self.OBJECTID_CACHE_SIZE)
+        imported = self.state.import_pickle(self.PICKLE_FILE)
+        if imported:
+            self.logger.info('Imported metadata of ' + str(imported) +
+                             ' nodes from ' + self.PICKLE_FILE)
+
+    def save_metadata(self, prune=True):
+        """
+        Save the metadata in the state store, writing only the nodes which
+        changed and, if prune is set, removing the nodes which are gone
+        The nodes whose changes could not be sent keep their previous
+        state, so that the changes are sent again in the next run
+        """
+        written = self.state.commit(
+            [node_information for node_information in self.nodes_metadata
+             if node_information['chefUniqueId'] not in self.unsent_ids],
+            self.fingerprints)
+        if prune:
+            self.state.delete(self.state.unique_ids() - self.listed_ids)
+        self.objectids.flush()
+        self.logger.info('Saved updated metadata of ' + str(written) +
+                         ' nodes to ' + self.STATE_FILE)
+
+    def send_all_metadata_to_signalfx(self):
+        """
+        Check for changes in the metadata of all the collected nodes
+        Resolve the ObjectIDs of the changed nodes which are not cached,
+        in batches, then send the changes to Signalfx, SIGNALFX_CONCURRENCY
+        nodes at a time
+
+        return: list of the chefUniqueIds of the changed nodes
+        """
+        headers = {
+            'X-SF-Token': self.SIGNALFX_API_TOKEN,
+        }
+        updates = []
         for node_information in self.nodes_metadata:
-            pickle_data[node_information['chefUniqueId']] = node_information
-            pickle_data[node_information['chefUniqueId']].pop('chefUniqueId')
-        output = open(self.PICKLE_FILE, 'wb')
-        pickle.dump(pickle_data, output)
-        self.logger.info('Saved updated metadata to ' + self.PICKLE_FILE)
-        output.close()
+            new_metadata = self.check_for_updates_in_metadata(
+                node_information)
+            self.count_update(new_metadata)
+            if new_metadata:
+                updates.append((node_information, new_metadata))
+            else:
+                self.logger.info('No new metadata is found for ' +
+                                 node_information['chefUniqueId'])
+        if self.UPDATE_MODE == 'params':
+            self.prefetch_signalfx_objectids(
+                [node_information['chefUniqueId']
+                 for node_information, new_metadata in updates], headers)
+        sent = self.send_updates_to_signalfx(updates, headers)
+        for (node_information, new_metadata), success in zip(updates, sent):
+            if not success:
+                self.unsent_ids.add(node_information['chefUniqueId'])
+        self.telemetry.increment('nodes.unsent', len(self.unsent_ids))
+        return [node_information['chefUniqueId']
+                for node_information, new_metadata in updates]
+
+    def count_update(self, new_metadata):
+        """
+        Count the node as changed or unchanged since the last run
+        """
+        if new_metadata:
+            self.telemetry.increment('nodes.changed')
+        else:
+            self.telemetry.increment('nodes.unchanged')
+
+    def report_telemetry(self):
+        """
+        Send the measurements of the run to Signalfx as datapoints if
+        TELEMETRY is set, and write them to STATS_FILE if one is given
+        A failure is logged but does not stop the program
+        """
+        if self.TELEMETRY:
+            try:
+                resp = self.signalfx.post(self.SIGNALFX_INGEST_API,
+                                          json=self.telemetry.datapoints())
+                if resp.status_code >= 400:
+                    self.logger.error('Unable to send telemetry: HTTP ' +
+                                      str(resp.status_code))
+            except SignalFxError:
+                self.logger.error('Unable to send telemetry', exc_info=True)
+        if self.STATS_FILE:
+            try:
+                self.telemetry.write_stats_file(self.STATS_FILE)
+            except (IOError, OSError):
+                self.logger.error('Unable to write ' + self.STATS_FILE,
+                                  exc_info=True)
+
+    def observe_signalfx_request(self, method, url, seconds):
+        """
+        Record the latency of a request made by the SignalFx client,
+        grouping the dimensions updated by their endpoint
+        """
+        path = urlparse(url).path
+        if path.startswith('/v1/dimension/'):
+            path = '/v1/dimension/<id>'
+        elif path.startswith('/v2/dimension/chefUniqueId/'):
+            path = '/v2/dimension/chefUniqueId/<value>/_/sfxagent'
+        self.telemetry.observe_request('signalfx ' + method + ' ' + path,
+                                       seconds)
 
     def send_metadata_to_signalfx(self, node_information):
         """
-        Get ObjectID of the chefUniqueId dimension from Signalfx
         Check for changes between newly collected metadata and last run's data
         If there are any updates, send those changes to Signalfx
+
+        return: False if there were changes which could not be sent
         """
         headers = {
             'X-SF-Token': self.SIGNALFX_API_TOKEN,
         }
-        resp = self.get_signalfx_objectid(node_information, headers)
-        if len(resp.json()['rs']) == 0:
+        new_metadata = self.check_for_updates_in_metadata(node_information)
+        if not new_metadata:
+            self.logger.info('No new metadata is found for ' +
+                             node_information['chefUniqueId'])
+            return True
+        return self.send_update_to_signalfx(node_information, new_metadata,
+                                            headers)
+
+    def send_updates_to_signalfx(self, updates, headers):
+        """
+        Send the updated metadata of several nodes to Signalfx using a pool
+        of SIGNALFX_CONCURRENCY threads, so that the requests overlap on
+        the pooled connections instead of waiting for each other
+
+        return: list of whether the changes of each node could be sent
+        """
+        def send(update):
+            return self.send_update_to_signalfx(update[0], update[1],
+                                                headers)
+
+        if self.SIGNALFX_CONCURRENCY <= 1 or len(updates) <= 1:
+            return [send(update) for update in updates]
+        pool = ThreadPool(min(self.SIGNALFX_CONCURRENCY, len(updates)))
+        try:
+            return pool.map(send, updates)
+        finally:
+            pool.close()
+            pool.join()
+
+    def send_update_to_signalfx(self, node_information, new_metadata,
+                                headers):
+        """
+        Get ObjectID of the chefUniqueId dimension and send the updated
+        metadata to Signalfx, or send it as a JSON body in the json
+        UPDATE_MODE
+
+        return: False if the changes could not be sent
+        """
+        if self.UPDATE_MODE == 'json':
+            return self.send_json_update_to_signalfx(node_information,
+                                                     new_metadata, headers)
+        signalfx_objectid = self.resolve_signalfx_objectid(
+            node_information, headers)
+        if signalfx_objectid is None:
+            return False
+        try:
+            with self.profiler.call('signalfx PATCH /v1/dimension/<id>',
+                                    node_information['chefUniqueId']):
+                resp = self.signalfx.patch(
+                    self.SIGNALFX_REST_API + '/' + signalfx_objectid,
+                    params=new_metadata, headers=headers)
+        except SignalFxError:
+            self.logger.error('Unable to update metadata of ' +
+                              node_information['chefUniqueId'],
+                              exc_info=True)
+            return False
+        if resp.status_code == 404:
+            self.logger.info('ObjectID ' + signalfx_objectid + ' of ' +
+                             node_information['chefUniqueId'] +
+                             ' no longer exists')
+            self.objectids.invalidate(node_information['chefUniqueId'])
+            return False
+        if resp.status_code >= 400:
+            self.logger.error('Unable to update metadata of ' +
+                              node_information['chefUniqueId'] + ': HTTP ' +
+                              str(resp.status_code))
+            return False
+        return True
+
+    def send_json_update_to_signalfx(self, node_information, new_metadata,
+                                     headers):
+        """
+        Send the updated metadata as the custom properties of the
+        chefUniqueId dimension in a JSON body to the partial update
+        endpoint of the v2 dimension API, addressing the dimension by its
+        value, so that no ObjectID is needed and the request size does not
+        depend on URL length limits
+        Dimensions which Signalfx does not have are remembered for
+        OBJECTID_NEGATIVE_TTL seconds, as in the params UPDATE_MODE
+
+        return: False if the changes could not be sent
+        """
+        unique_id = node_information['chefUniqueId']
+        properties = dict((key, value)
+                          for key, value in new_metadata.items()
+                          if key != 'chefUniqueId')
+        if not properties:
+            return True
+        found, signalfx_objectid = self.objectids.lookup(unique_id)
+        if found and signalfx_objectid is None:
             self.logger.info('Signalfx does not have an object '
                              + 'for your dimension chefUniqueId:'
-                             + node_information['chefUniqueId'])
+                             + unique_id)
+            return False
+        try:
+            with self.profiler.call(
+                    'signalfx PATCH /v2/dimension/<value>/_/sfxagent',
+                    unique_id):
+                resp = self.signalfx.patch(
+                    self.SIGNALFX_DIMENSION_API + quote(unique_id, safe='') +
+                    '/_/sfxagent',
+                    json={'customProperties': properties,
+                          'tags': [], 'tagsToRemove': []},
+                    headers=headers)
+        except SignalFxError:
+            self.logger.error('Unable to update metadata of ' + unique_id,
+                              exc_info=True)
+            return False
+        if resp.status_code == 404:
+            self.logger.info('Dimension of ' + unique_id +
+                             ' is not found on Signalfx')
+            self.objectids.put(unique_id, None)
+            return False
+        if resp.status_code >= 400:
+            self.logger.error('Unable to update metadata of ' + unique_id +
+                              ': HTTP ' + str(resp.status_code))
+            return False
+        return True
+
+    def prefetch_signalfx_objectids(self, unique_ids, headers):
+        """
+        Look up the ObjectIDs of the given chefUniqueIds which are not
+        cached with batched queries and cache them
+        """
+        missing_ids = [unique_id for unique_id in unique_ids
+                       if not self.objectids.lookup(unique_id)[0]]
+        if not missing_ids:
             return
-        signalfx_objectid = resp.json()['rs'][0]
-        self.logger.info("ObjectID for " + node_information['chefUniqueId']
+        signalfx_objectids = self.get_signalfx_objectids(missing_ids,
+                                                         headers)
+        for unique_id, signalfx_objectid in signalfx_objectids.items():
+            self.objectids.put(unique_id, signalfx_objectid)
+        self.logger.info('Looked up ' + str(len(signalfx_objectids)) +
+                         ' of ' + str(len(missing_ids)) + ' ObjectIDs')
+
+    def resolve_signalfx_objectid(self, node_information, headers):
+        """
+        Get ObjectID of the chefUniqueId dimension from the cache, or from
+        Signalfx if it is not cached
+
+        return: ObjectID or None if Signalfx does not have the dimension
+        """
+        unique_id = node_information['chefUniqueId']
+        found, signalfx_objectid = self.objectids.lookup(unique_id)
+        if not found:
+            resp = self.get_signalfx_objectid(node_information, headers)
+            if resp is None:
+                return None
+            if len(resp.json()['rs']) > 0:
+                signalfx_objectid = resp.json()['rs'][0]
+            self.objectids.put(unique_id, signalfx_objectid)
+        if signalfx_objectid is None:
+            self.logger.info('Signalfx does not have an object '
+                             + 'for your dimension chefUniqueId:'
+                             + unique_id)
+            return None
+        self.logger.info("ObjectID for " + unique_id
                          + " is " + signalfx_objectid)
-        new_metadata = self.check_for_updates_in_metadata(
-            copy.deepcopy(node_information))
-        if new_metadata:
-            resp = requests.patch(
-                self.SIGNALFX_REST_API + '/' + signalfx_objectid,
-                params=new_metadata, headers=headers)
-        else:
-            self.logger.info('No new metadata is found for ' +
-                             node_information['chefUniqueId'])
+        return signalfx_objectid
 
     def check_for_updates_in_metadata(self, current_data):
         """
-        Read the data saved in the last run
-        Compare it with the current metadata and pop unchanged items
+        Look up the data saved in the last run
+        Compare it with the current metadata, leaving both unchanged
 
-        return: Recently updated metadata
+        return: dictionary of the recently updated metadata
         """
-        input_pickle = open(self.PICKLE_FILE, 'rb')
-        self.logger.info('Reading previous metadata from ' + self.PICKLE_FILE)
-        saved_metadata = pickle.load(input_pickle)
-        input_pickle.close()
-        if current_data['chefUniqueId'] not in saved_metadata:
-            return current_data
-        previous_data = saved_metadata[current_data['chefUniqueId']]
-        for key in previous_data.keys():
-            if key in current_data and current_data[key] == previous_data[key]:
-                current_data.pop(key)
-        current_data.pop('chefUniqueId')
-        return current_data
+        previous_data = self.state.get(current_data['chefUniqueId'])
+        if previous_data is None:
+            return dict(current_data.items())
+        return dict((key, value) for key, value in current_data.items()
+                    if key != 'chefUniqueId' and
+                    previous_data.get(key) != value)
 
     def get_signalfx_objectid(self, node_information, headers):
         """
         Get ObjectID of the chefUniqueId dimension from Signalfx
 
-        return: the api response
+        return: the api response or None if the query failed
         """
         params = {
             'query': 'chefUniqueId:' + node_information['chefUniqueId'],
             'getIDs': 'true'
         }
         try:
-            resp = requests.get(self.SIGNALFX_REST_API,
-                                params=params, headers=headers)
-        except:
+            with self.profiler.call('signalfx GET /v1/dimension',
+                                    node_information['chefUniqueId']):
+                resp = self.signalfx.get(self.SIGNALFX_REST_API,
+                                         params=params, headers=headers)
+            resp.json()
+        except Exception:
             self.logger.error('Unable to query Signalfx REST API',
                               exc_info=True)
-            self.exit_now()
+            return None
+        if resp.status_code >= 400:
+            self.logger.error('Unable to query Signalfx REST API for ' +
+                              node_information['chefUniqueId'] + ': HTTP ' +
+                              str(resp.status_code))
+            return None
         return resp
 
+    def get_signalfx_objectids(self, unique_ids, headers):
+        """
+        Get ObjectIDs of many chefUniqueId dimensions from Signalfx using
+        queries like chefUniqueId:(a OR b OR c), each with at most
+        OBJECTID_BATCH_SIZE values and MAX_OBJECTID_QUERY_LENGTH characters
+
+        return: dictionary of chefUniqueId to ObjectID, or to None if
+        Signalfx does not have the dimension. The chefUniqueIds of failed
+        queries are left out.
+        """
+        signalfx_objectids = {}
+        for query, query_ids in self.build_objectid_queries(unique_ids):
+            try:
+                signalfx_objectids.update(
+                    self.get_signalfx_objectids_for_query(query, headers))
+            except Exception:
+                self.logger.error('Unable to query Signalfx REST API',
+                                  exc_info=True)
+                continue
+            for unique_id in query_ids:
+                signalfx_objectids.setdefault(unique_id, None)
+        return signalfx_objectids
+
+    def get_signalfx_objectids_for_query(self, query, headers):
+        """
+        Page through the dimensions matching the query
+
+        return: dictionary of chefUniqueId to ObjectID
+        """
+        signalfx_objectids = {}
+        offset = 0
+        while True:
+            params = {
+                'query': query,
+                'offset': offset,
+                'limit': self.OBJECTID_BATCH_SIZE
+            }
+            with self.profiler.call('signalfx GET /v1/dimension?query'):
+                results = self.signalfx.get(self.SIGNALFX_REST_API,
+                                            params=params,
+                                            headers=headers).json()
+            for result in results['rs']:
+                if 'chefUniqueId' in result and 'sf_id' in result:
+                    signalfx_objectids[result['chefUniqueId']] = \
+                        result['sf_id']
+            offset += len(results['rs'])
+            if len(results['rs']) == 0 or \
+                    offset >= results.get('count', offset + 1):
+                return signalfx_objectids
+
+    def build_objectid_queries(self, unique_ids):
+        """
+        Split the given chefUniqueIds into queries matching any of them
+
+        return: list of tuples of (query string, chefUniqueIds)
+        """
+        queries = []
+        query_ids = []
+        values = []
+        length = 0
+        for unique_id in unique_ids:
+            value = self.query_special_characters.sub(r'\\\1', unique_id)
+            if values and (len(values) >= self.OBJECTID_BATCH_SIZE or
+                           length + len(value) + 4 >
+                           MAX_OBJECTID_QUERY_LENGTH):
+                queries.append(('chefUniqueId:(' + ' OR '.join(values) + ')',
+                                query_ids))
+                query_ids = []
+                values = []
+                length = 0
+            query_ids.append(unique_id)
+            values.append(value)
+            length += len(value) + 4
+        if values:
+            queries.append(('chefUniqueId:(' + ' OR '.join(values) + ')',
+                            query_ids))
+        return queries
+
     def read_config(self):
         """
         Read the configuration file and get the user selected attributes
+        The file is read again only when its modification time changes
         """
-        self.config = []
+        config_mtime = os.path.getmtime(self.CONFIG_FILE)
+        if config_mtime == self.config_mtime:
+            return
+        config = []
         with open(self.CONFIG_FILE, 'r') as f:
             lines = f.readlines()
             for line in lines:
@@ -162,7 +999,23 @@ class ChefMetadata(object):
                     attribute = line.rstrip('\n')
                     if self.check_property_name_syntax(attribute
                                                        .replace('.', '_')):
-                        self.config.append(attribute)
+                        config.append(attribute)
+        self.config = config
+        self.config_mtime = config_mtime
+        self.get_extraction_plan()
+
+    def get_extraction_plan(self):
+        """
+        Compile the user selected attributes into an extraction plan,
+        unless the plan of the current attributes is already compiled
+
+        return: ExtractionPlan
+        """
+        if self.extraction_plan is None or \
+                self.extraction_plan.attributes is not self.config:
+            self.extraction_plan = ExtractionPlan(self.config,
+                                                  self.adjust_attribute_name)
+        return self.extraction_plan
 
     def check_property_name_syntax(self, attribute):
         """
@@ -187,19 +1040,64 @@ class ChefMetadata(object):
               "! Exiting...")
         sys.exit(1)
 
+    def get_chef_api(self, chef_config):
+        """
+        Configure the Chef Server API from the given knife.rb or client.rb
+        file, or for the given organization URL with the key and client of
+        the default knife configuration
+        Without chef_config, the default knife configuration is used
+
+        return: ChefAPI object
+        """
+        if not chef_config:
+            return autoconfigure()
+        if re.match('^https?://', chef_config):
+            default_api = autoconfigure()
+            api = None
+            if default_api is not None:
+                api = ChefAPI(chef_config, default_api.key,
+                              default_api.client,
+                              version=default_api.version,
+                              ssl_verify=default_api.ssl_verify)
+        else:
+            api = ChefAPI.from_config_file(chef_config)
+        if api is None:
+            self.logger.error('Unable to configure the Chef API from ' +
+                              chef_config)
+            self.exit_now()
+        return api
+
     def chef_api_get_request(self, endpoint):
         """
         GET the data from Chef Server API for the given endpoint
         """
         value = None
         try:
-            value = self.api.api_request('GET', endpoint)
+            with self.telemetry.request('chef GET ' + (endpoint or '/')), \
+                    self.profiler.call('chef GET ' + (endpoint or '/')):
+                value = self.api.api_request('GET', endpoint)
         except Exception:
             self.logger.error(
                 'Unable to perform Chef api GET request', exc_info=True)
             self.exit_now()
         return value
 
+    def chef_api_post_request(self, endpoint, data):
+        """
+        POST the data to Chef Server API for the given endpoint
+        """
+        value = None
+        try:
+            with self.telemetry.request('chef POST ' +
+                                        endpoint.split('?')[0]), \
+                    self.profiler.call('chef POST ' + endpoint):
+                value = self.api.api_request('POST', endpoint, data=data)
+        except Exception:
+            self.logger.error(
+                'Unable to perform Chef api POST request', exc_info=True)
+            self.exit_now()
+        return value
+
     def collect_metadata_from_chef(self):
         """
         GET the organization name and its nodes from Chef Server API
@@ -207,27 +1105,224 @@ class ChefMetadata(object):
         """
         organization_details = self.chef_api_get_request('')
         self.organization = organization_details['name']
-        nodes = self.chef_api_get_request('/nodes')
-        for node_name in nodes.keys():
+        if self.COLLECTION_MODE == 'partial-search':
+            self.collect_metadata_from_chef_search()
+            return
+        node_names = list(self.list_nodes())
+        if self.CHEF_CONCURRENCY > 1:
+            self.collect_node_information_concurrently(node_names)
+            return
+        for node_name in node_names:
             self.get_node_information(node_name)
 
+    def list_nodes(self, search_rows=None):
+        """
+        List the nodes of the organization, recording their chefUniqueIds
+        In shard mode, only the nodes of this shard are listed
+        In incremental mode, only the nodes whose fingerprint changed since
+        the last run are listed
+        In the partial-search collection mode, the data of every node of
+        this shard, changed or not, is also stored in search_rows by node
+        name if it is given
+
+        return: generator of node names, or of node data returned by the
+        partial search API in the partial-search collection mode
+        """
+        if self.COLLECTION_MODE == 'partial-search':
+            keys = self.get_search_keys()
+            if self.INCREMENTAL:
+                keys['ohai_time'] = ['ohai_time']
+            for node_data in self.search_nodes(keys):
+                node_name = node_data['name']
+                if search_rows is not None and self.owns_node(node_name):
+                    search_rows[node_name] = node_data
+                if self.track_node(node_name, node_data):
+                    yield node_data
+        elif self.INCREMENTAL:
+            for node_data in self.search_nodes(FINGERPRINT_SEARCH_KEYS):
+                if self.track_node(node_data['name'], node_data):
+                    yield node_data['name']
+        else:
+            for node_name in self.chef_api_get_request('/nodes').keys():
+                if self.track_node(node_name):
+                    yield node_name
+
+    def track_node(self, node_name, node_data=None):
+        """
+        Record the chefUniqueId of the node and, in incremental mode, the
+        fingerprint of its data
+        Nodes owned by another shard are not recorded, so that their state
+        is removed from the state store of this shard
+
+        return: False if the node belongs to another shard or can be
+        skipped because its fingerprint did not change since the last run
+        """
+        if not self.owns_node(node_name):
+            return False
+        unique_id = self.organization + "_" + node_name
+        self.listed_ids.add(unique_id)
+        if not self.INCREMENTAL:
+            return True
+        fingerprint = self.get_node_fingerprint(node_data)
+        self.fingerprints[unique_id] = fingerprint
+        return self.saved_fingerprints.get(unique_id) != fingerprint
+
+    def owns_node(self, node_name):
+        """
+        return: False if the node belongs to another shard
+        """
+        return self.SHARD_COUNT <= 1 or \
+            shard_of(node_name, self.SHARD_COUNT) == self.SHARD_INDEX
+
+    def get_node_fingerprint(self, node_data):
+        """
+        Hash the last Chef client run time (ohai_time) and the environment
+        of the node together with the selected attributes, so that the
+        fingerprint also moves when configuration.txt changes
+
+        return: fingerprint string
+        """
+        fingerprint_data = [node_data.get('ohai_time'),
+                            node_data.get('chef_environment'),
+                            self.config]
+        return hashlib.sha1(json.dumps(fingerprint_data).encode('utf-8')) \
+            .hexdigest()
+
+    def collect_node_information_concurrently(self, node_names):
+        """
+        Collect the node information of the given nodes using a pool of
+        CHEF_CONCURRENCY threads
+        A node that cannot be collected is logged and skipped instead of
+        stopping the program
+        """
+        pool = ThreadPool(self.CHEF_CONCURRENCY)
+        try:
+            results = pool.map(self.try_fetch_node_information, node_names)
+        finally:
+            pool.close()
+            pool.join()
+        for node_information in results:
+            if node_information is not None:
+                self.nodes_metadata.append(node_information)
+
+    def try_fetch_node_information(self, node_name):
+        """
+        Fetch the node information, logging the error if it fails
+
+        return: node information or None
+        """
+        try:
+            return self.fetch_node_information(node_name)
+        except Exception:
+            self.logger.error('Unable to collect metadata of node '
+                              + node_name, exc_info=True)
+            return None
+
     def get_node_information(self, node_name):
         """
-        Get node attributes(metadata) using Node.attributes of PyChef
         Store the values of the attributes selected by the user for each node
+        A node that cannot be collected is logged and skipped instead of
+        stopping the program, as in the concurrent collection
+        """
+        node_information = self.try_fetch_node_information(node_name)
+        if node_information is not None:
+            self.nodes_metadata.append(node_information)
+
+    def fetch_node_information(self, node_name):
+        """
+        Get node attributes(metadata) using Node.attributes of PyChef
+
+        return: NodeRecord of the attributes selected by the user
         """
         chefUniqueId = self.organization + "_" + node_name
-        node_details = Node(node_name)
-        node_information = {}
-        node_information['chefUniqueId'] = chefUniqueId
-        node_information['chef_environment'] = node_details.chef_environment
+        # PyChef keeps its default API per thread, pass it explicitly
+        with self.telemetry.request('chef GET /nodes/<name>'), \
+                self.profiler.call('chef GET /nodes/<name>', chefUniqueId):
+            node_details = Node(node_name, api=self.api)
+        self.profiler.record_size(chefUniqueId, node_details.attributes)
+        plan = self.get_extraction_plan()
+        properties = {'chef_environment': node_details.chef_environment}
+        missing = []
+        for attribute, property_name, value in \
+                plan.extract(node_details, missing):
+            attribute_value = self.format_attribute_value(attribute, value)
+            if attribute_value:
+                properties[property_name] = attribute_value
+        if missing:
+            self.logger.debug('Attributes ' + ', '.join(missing) +
+                              ' are missing on node ' + node_name)
+        return plan.new_record(chefUniqueId, properties, self.interner)
+
+    def get_search_keys(self):
+        """
+        Map each user selected attribute to its path in the node object,
+        as expected by the partial search API
+
+        return: dictionary of search keys
+        """
+        keys = {
+            'name': ['name'],
+            'chef_environment': ['chef_environment'],
+        }
         for attribute in self.config:
-            attribute_value = self.get_attribute_value(
-                attribute, node_details)
+            keys[attribute] = attribute.split('.')
+        return keys
+
+    def collect_metadata_from_chef_search(self):
+        """
+        Collect the values for the user selected attributes of all nodes
+        using the partial search API of Chef Server, SEARCH_ROWS nodes
+        per request, instead of downloading every node object
+        """
+        for node_data in self.list_nodes():
+            self.get_node_information_from_search(node_data)
+
+    def search_nodes(self, keys):
+        """
+        Page through all the nodes with the partial search API of Chef
+        Server, SEARCH_ROWS nodes per request
+
+        return: generator of the data of each node for the given keys
+        """
+        start = 0
+        while True:
+            result = self.chef_api_post_request(
+                '/search/node?q=*:*&start=' + str(start) +
+                '&rows=' + str(self.SEARCH_ROWS), keys)
+            rows = result['rows']
+            for row in rows:
+                yield row['data']
+            start += len(rows)
+            if len(rows) == 0 or start >= result['total']:
+                break
+
+    def get_node_information_from_search(self, node_data):
+        """
+        Store the values of the attributes selected by the user for a node
+        returned by the partial search API
+        """
+        self.nodes_metadata.append(
+            self.build_node_information_from_search(node_data))
+
+    def build_node_information_from_search(self, node_data):
+        """
+        Get the values of the attributes selected by the user from the
+        data of a node returned by the partial search API
+
+        return: NodeRecord of the attributes selected by the user
+        """
+        chefUniqueId = self.organization + "_" + node_data['name']
+        self.profiler.record_size(chefUniqueId, node_data)
+        plan = self.get_extraction_plan()
+        properties = {'chef_environment': node_data['chef_environment']}
+        for attribute, property_name in plan.targets:
+            if node_data.get(attribute) is None:
+                continue
+            attribute_value = self.format_attribute_value(
+                attribute, node_data[attribute])
             if attribute_value:
-                attribute = self.adjust_attribute_name(attribute)
-                node_information[attribute] = attribute_value
-        self.nodes_metadata.append(node_information)
+                properties[property_name] = attribute_value
+        return plan.new_record(chefUniqueId, properties, self.interner)
 
     def adjust_attribute_name(self, attribute):
         """
@@ -256,14 +1351,157 @@ class ChefMetadata(object):
                                   ' is listed in '
                                   + self.CONFIG_FILE, exc_info=True)
                 return None
-        if isinstance(temp_value, dict):
+        return self.format_attribute_value(attribute, temp_value)
+
+    def format_attribute_value(self, attribute, value):
+        """
+        Return the given attribute value as a string
+        If the value is a list, join the values into a single string
+        using '$'.
+        If the value is a dictionary, log an error
+        """
+        # Nested attributes of a PyChef Node are NodeAttributes mappings
+        if isinstance(value, Mapping):
             self.logger.error('Attribute value for ' +
                               attribute + ' cannot be a dictionary!')
             return None
-        if isinstance(temp_value, list) and not (
-                any(isinstance(x, dict) for x in temp_value)):
-            return '$'.join(temp_value)
-        return str(temp_value)
+        if isinstance(value, list) and not (
+                any(isinstance(x, dict) for x in value)):
+            return '$'.join(value)
+        return str(value)
+
+
+class MultiOrgChefMetadata(object):
+    """
+    Collect and send metadata of several chef organizations to SignalFx,
+    sweeping them concurrently from one process
+
+    The organizations share the connections and the rate limit to
+    SignalFx and the ObjectID cache, kept in STATE_FILE. The metadata of
+    each organization is kept in its own state file, named after the
+    organization, as are its stats and profile files.
+    """
+
+    def __init__(self, CHEF_CONFIGS, **kwargs):
+        self.RUN_MODE = kwargs.get('RUN_MODE', DEFAULT_RUN_MODE)
+        self.SLEEP_DURATION = kwargs.get('SLEEP_DURATION',
+                                         DEFAULT_SLEEP_DURATION)
+        self.collectors = [ChefMetadata(CHEF_CONFIG=chef_config, **kwargs)
+                           for chef_config in CHEF_CONFIGS]
+        first = self.collectors[0]
+        self.logger = first.logger
+        self.objectids = ObjectIdCache(
+            StateStore(first.STATE_FILE), first.OBJECTID_TTL,
+            first.OBJECTID_NEGATIVE_TTL, first.OBJECTID_CACHE_SIZE)
+        organizations = set()
+        for collector in self.collectors:
+            if collector is not first:
+                # Log through the handler of the first one only
+                collector.logger.removeHandler(collector.handler)
+                collector.handler = first.handler
+                collector.signalfx.session = first.signalfx.session
+                collector.signalfx.limiter = first.signalfx.limiter
+            collector.objectids = self.objectids
+            organization = collector.chef_api_get_request('')['name']
+            collector.organization = organization
+            if organization in organizations:
+                self.logger.error('Organization ' + organization +
+                                  ' is listed more than once')
+                first.exit_now()
+            organizations.add(organization)
+            collector.telemetry.dimensions['organization'] = organization
+            collector.STATE_FILE = get_organization_path(
+                collector.STATE_FILE, organization)
+            if collector.STATS_FILE:
+                collector.STATS_FILE = get_organization_path(
+                    collector.STATS_FILE, organization)
+            if collector.PROFILE:
+                collector.PROFILE = get_organization_path(
+                    collector.PROFILE, organization)
+
+    def run(self):
+        """
+        Run one sweep of every organization concurrently, or one after the
+        other when PROFILE is set, as only one cProfile profiler can be
+        active at a time
+        """
+        self.run_collectors(lambda collector: collector.run(),
+                            concurrent=not self.collectors[0].PROFILE)
+
+    def run_adaptive(self):
+        """
+        Run the adaptive schedule of every organization concurrently
+        """
+        self.run_collectors(lambda collector: collector.run_adaptive())
+
+    def run_daemon(self):
+        """
+        Listen for the notifications of all organizations on NOTIFY_PORT
+        and run the daemon mode of every organization concurrently
+        """
+        first = self.collectors[0]
+        server = NotificationServer(first.NOTIFY_ADDRESS, first.NOTIFY_PORT,
+                                    self.accept_notification, self.logger)
+        server.start()
+        self.logger.info('Listening for notifications on ' +
+                         first.NOTIFY_ADDRESS + ':' + str(server.port))
+        self.run_collectors(
+            lambda collector: collector.serve_notifications())
+
+    def accept_notification(self, node_name, organization):
+        """
+        Queue a notified node for the collector of its organization, which
+        the notification has to name
+
+        return: False if no collector syncs the node
+        """
+        for collector in self.collectors:
+            if collector.organization == organization:
+                return collector.accept_notification(node_name, organization)
+        return False
+
+    def run_collectors(self, function, concurrent=True):
+        """
+        Call the function with each collector in its own thread and wait
+        for all of them, or with one collector after the other if not
+        concurrent
+        A collector stopped by an error does not stop the others, but the
+        program exits with an error once they are done
+        """
+        failed = []
+
+        def target(collector):
+            try:
+                function(collector)
+            except SystemExit:
+                # raised by exit_now(), which already logged the error
+                failed.append(collector)
+            except Exception:
+                self.logger.error('Unable to sweep organization ' +
+                                  collector.organization, exc_info=True)
+                failed.append(collector)
+
+        if concurrent:
+            threads = [threading.Thread(target=target, args=(collector,))
+                       for collector in self.collectors]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for collector in self.collectors:
+                target(collector)
+        if failed:
+            self.collectors[0].exit_now()
+
+
+def get_organization_path(path, organization):
+    """
+    return: the path with the organization name inserted before its
+    extension
+    """
+    root, extension = os.path.splitext(path)
+    return root + '.' + organization + extension
 
 
 def get_argument_parser():
@@ -312,14 +1550,217 @@ def get_argument_parser():
     parser.add_argument('--pickle-file', action='store',
                         dest='PICKLE_FILE',
                         default=DEFAULT_PICKLE_FILE,
-                        help='Pickle file to store the last retrieved ' +
-                        'metadata. Default is ./' + DEFAULT_PICKLE_FILE,
+                        help='Pickle file with the metadata saved by ' +
+                        'earlier versions. It is imported into the state ' +
+                        'file when the state file is empty. ' +
+                        'Default is ./' + DEFAULT_PICKLE_FILE,
+                        type=str)
+    parser.add_argument('--state-file', action='store',
+                        dest='STATE_FILE',
+                        default=DEFAULT_STATE_FILE,
+                        help='SQLite file to store the last retrieved ' +
+                        'metadata. Default is ./' + DEFAULT_STATE_FILE,
                         type=str)
+    parser.add_argument('--objectid-ttl', action='store',
+                        dest='OBJECTID_TTL',
+                        default=DEFAULT_OBJECTID_TTL,
+                        help='Time (in seconds) to cache the SignalFx ' +
+                        'ObjectID of a chefUniqueId dimension. ' +
+                        'Default is ' + str(DEFAULT_OBJECTID_TTL), type=int)
+    parser.add_argument('--objectid-negative-ttl', action='store',
+                        dest='OBJECTID_NEGATIVE_TTL',
+                        default=DEFAULT_OBJECTID_NEGATIVE_TTL,
+                        help='Time (in seconds) to remember that SignalFx ' +
+                        'has no dimension for a chefUniqueId. ' +
+                        'Default is ' + str(DEFAULT_OBJECTID_NEGATIVE_TTL),
+                        type=int)
+    parser.add_argument('--objectid-cache-size', action='store',
+                        dest='OBJECTID_CACHE_SIZE',
+                        default=DEFAULT_OBJECTID_CACHE_SIZE,
+                        help='Maximum number of cached ObjectIDs. ' +
+                        'Default is ' + str(DEFAULT_OBJECTID_CACHE_SIZE),
+                        type=int)
+    parser.add_argument('--objectid-batch-size', action='store',
+                        dest='OBJECTID_BATCH_SIZE',
+                        default=DEFAULT_OBJECTID_BATCH_SIZE,
+                        help='Maximum number of chefUniqueIds resolved ' +
+                        'by one SignalFx query. ' +
+                        'Default is ' + str(DEFAULT_OBJECTID_BATCH_SIZE),
+                        type=int)
+    parser.add_argument('--signalfx-rate-limit', action='store',
+                        dest='SIGNALFX_RATE_LIMIT',
+                        default=DEFAULT_SIGNALFX_RATE_LIMIT,
+                        help='Maximum number of SignalFx REST API ' +
+                        'requests per second, 0 for no limit. ' +
+                        'Default is ' + str(DEFAULT_SIGNALFX_RATE_LIMIT),
+                        type=float)
+    parser.add_argument('--signalfx-max-retries', action='store',
+                        dest='SIGNALFX_MAX_RETRIES',
+                        default=DEFAULT_SIGNALFX_MAX_RETRIES,
+                        help='Number of retries of a SignalFx REST API ' +
+                        'request failing with a connection error, a 5xx ' +
+                        'or a 429 response. ' +
+                        'Default is ' + str(DEFAULT_SIGNALFX_MAX_RETRIES),
+                        type=int)
+    parser.add_argument('--signalfx-concurrency', action='store',
+                        dest='SIGNALFX_CONCURRENCY',
+                        default=DEFAULT_SIGNALFX_CONCURRENCY,
+                        help='Number of metadata updates sent to ' +
+                        'SignalFx at the same time. ' +
+                        'Default is ' + str(DEFAULT_SIGNALFX_CONCURRENCY),
+                        type=int)
+    parser.add_argument('--update-mode', action='store',
+                        dest='UPDATE_MODE',
+                        default=DEFAULT_UPDATE_MODE,
+                        choices=('params', 'json'),
+                        help='Choose between \'params\', which looks up ' +
+                        'the ObjectID of each dimension and sends the ' +
+                        'changes as URL parameters to the v1 dimension ' +
+                        'API, and \'json\', which sends the changes as a ' +
+                        'JSON body to the partial update endpoint of the ' +
+                        'v2 dimension API, addressing the dimension by ' +
+                        'its chefUniqueId. ' +
+                        'Default is ' + DEFAULT_UPDATE_MODE, type=str)
     parser.add_argument('--sleep-duration', action='store',
                         dest='SLEEP_DURATION',
                         default=DEFAULT_SLEEP_DURATION,
                         help='Specify the sleep duration (in seconds).' +
                         'Default is ' + str(DEFAULT_SLEEP_DURATION), type=int)
+    parser.add_argument('--collection-mode', action='store',
+                        dest='COLLECTION_MODE',
+                        default=DEFAULT_COLLECTION_MODE,
+                        choices=('nodes', 'partial-search'),
+                        help='Choose between \'nodes\', which downloads ' +
+                        'every node object, and \'partial-search\', which ' +
+                        'fetches only the selected attributes of all nodes ' +
+                        'in pages using the Chef partial search API. ' +
+                        'Default is ' + DEFAULT_COLLECTION_MODE, type=str)
+    parser.add_argument('--search-rows', action='store',
+                        dest='SEARCH_ROWS',
+                        default=DEFAULT_SEARCH_ROWS,
+                        help='Number of nodes per partial search ' +
+                        'request. Default is ' + str(DEFAULT_SEARCH_ROWS),
+                        type=int)
+    parser.add_argument('--chef-concurrency', action='store',
+                        dest='CHEF_CONCURRENCY',
+                        default=DEFAULT_CHEF_CONCURRENCY,
+                        help='Number of nodes fetched in parallel from ' +
+                        'Chef Server API in the nodes collection mode. ' +
+                        'Default is ' + str(DEFAULT_CHEF_CONCURRENCY),
+                        type=int)
+    parser.add_argument('--run-mode', action='store',
+                        dest='RUN_MODE',
+                        default=DEFAULT_RUN_MODE,
+                        choices=('batch', 'pipeline', 'adaptive'),
+                        help='Choose between \'batch\', which collects ' +
+                        'all nodes before sending their metadata, ' +
+                        '\'pipeline\', which collects, sends and saves ' +
+                        'the nodes in concurrent stages, and ' +
+                        '\'adaptive\', which lists the nodes every ' +
+                        'SLEEP_DURATION and syncs each node again after ' +
+                        'SLEEP_DURATION if it changed, or after twice ' +
+                        'its previous delay, up to MAX_INTERVAL, if it ' +
+                        'did not. Default is ' + DEFAULT_RUN_MODE, type=str)
+    parser.add_argument('--max-interval', action='store',
+                        dest='MAX_INTERVAL',
+                        default=DEFAULT_MAX_INTERVAL,
+                        help='Longest delay in seconds between two syncs ' +
+                        'of a node which does not change, in the ' +
+                        'adaptive run mode. ' +
+                        'Default is ' + str(DEFAULT_MAX_INTERVAL), type=int)
+    parser.add_argument('--pipeline-queue-size', action='store',
+                        dest='PIPELINE_QUEUE_SIZE',
+                        default=DEFAULT_PIPELINE_QUEUE_SIZE,
+                        help='Maximum number of nodes waiting between two ' +
+                        'stages of the pipeline run mode. ' +
+                        'Default is ' + str(DEFAULT_PIPELINE_QUEUE_SIZE),
+                        type=int)
+    parser.add_argument('--incremental', action='store_true',
+                        dest='INCREMENTAL',
+                        default=False,
+                        help='Only collect the nodes whose last Chef ' +
+                        'client run (ohai_time) or environment changed ' +
+                        'since the last run, using one partial search ' +
+                        'over all nodes. Attributes edited outside a ' +
+                        'Chef client run are picked up by the next run ' +
+                        'of the node. Default is False')
+    parser.add_argument('--telemetry', action='store_true',
+                        dest='TELEMETRY',
+                        default=False,
+                        help='Send the duration of each run and phase, ' +
+                        'the request latencies and the node counts to ' +
+                        'Signalfx as chef_metadata.* datapoints. ' +
+                        'Default is False')
+    parser.add_argument('--signalfx-ingest-api', action='store',
+                        dest='SIGNALFX_INGEST_API',
+                        default=DEFAULT_SIGNALFX_INGEST_API,
+                        help='SignalFx Ingest API base URL used by ' +
+                        '--telemetry. Default is ' +
+                        DEFAULT_SIGNALFX_INGEST_API, type=str)
+    parser.add_argument('--stats-file', action='store',
+                        dest='STATS_FILE',
+                        default=None,
+                        help='Write the measurements of each run to this ' +
+                        'JSON file. Default is None', type=str)
+    parser.add_argument('--shard-index', action='store',
+                        dest='SHARD_INDEX',
+                        default=DEFAULT_SHARD_INDEX,
+                        help='Index of this collector, from 0 to ' +
+                        'SHARD_COUNT - 1, when the nodes are split ' +
+                        'between several collectors. ' +
+                        'Default is ' + str(DEFAULT_SHARD_INDEX), type=int)
+    parser.add_argument('--shard-count', action='store',
+                        dest='SHARD_COUNT',
+                        default=DEFAULT_SHARD_COUNT,
+                        help='Number of collectors splitting the nodes ' +
+                        'between them by consistent hashing of the node ' +
+                        'names. Each collector needs its own state file. ' +
+                        'Default is ' + str(DEFAULT_SHARD_COUNT), type=int)
+    parser.add_argument('--chef-config', action='append',
+                        dest='CHEF_CONFIGS',
+                        default=None,
+                        help='knife.rb or client.rb file of a Chef ' +
+                        'organization, or URL of an organization using ' +
+                        'the key and client of the default knife ' +
+                        'configuration. Repeat it to collect several ' +
+                        'organizations concurrently. Default is the ' +
+                        'default knife configuration', type=str)
+    parser.add_argument('--notify-port', action='store',
+                        dest='NOTIFY_PORT',
+                        default=None,
+                        help='Run as a daemon listening on this port for ' +
+                        'notifications that a node converged, syncing ' +
+                        'the node right away while the sweeps keep ' +
+                        'running in the background. Default is None', type=int)
+    parser.add_argument('--notify-address', action='store',
+                        dest='NOTIFY_ADDRESS',
+                        default=DEFAULT_NOTIFY_ADDRESS,
+                        help='Address the notification listener binds to. ' +
+                        'Default is ' + DEFAULT_NOTIFY_ADDRESS, type=str)
+    parser.add_argument('--time-budget', action='store',
+                        dest='TIME_BUDGET',
+                        default=None,
+                        help='Stop a run after this many seconds, saving ' +
+                        'the nodes as they are synced, and start the next ' +
+                        'run where this one stopped. Not used by the ' +
+                        'adaptive run mode and not allowed with the ' +
+                        'pipeline run mode. Default is None', type=int)
+    parser.add_argument('--profile', action='store',
+                        dest='PROFILE',
+                        default=None,
+                        help='Profile each run with cProfile, write the ' +
+                        'profile to this file and print the slowest nodes ' +
+                        'and calls and the largest nodes. Not used by the ' +
+                        'adaptive run mode nor by the sweeps of the daemon ' +
+                        'mode. Several organizations are swept one after ' +
+                        'the other while profiling. Default is None',
+                        type=str)
+    parser.add_argument('--profile-top', action='store',
+                        dest='PROFILE_TOP',
+                        default=DEFAULT_PROFILE_TOP,
+                        help='Number of nodes and calls in each list of ' +
+                        'the profile report. Default is ' +
+                        str(DEFAULT_PROFILE_TOP), type=int)
     parser.add_argument('--use-cron', action="store_true",
                         default=False,
                         help='use this option if you want to run the ' +
@@ -336,6 +1777,15 @@ def main(argv):
     """
     parser = get_argument_parser()
     user_args = vars(parser.parse_args(argv))
+    if not 0 <= user_args['SHARD_INDEX'] < user_args['SHARD_COUNT']:
+        parser.error('--shard-index must be between 0 and --shard-count - 1')
+    for option, dest in (('--chef-concurrency', 'CHEF_CONCURRENCY'),
+                         ('--signalfx-concurrency', 'SIGNALFX_CONCURRENCY'),
+                         ('--objectid-batch-size', 'OBJECTID_BATCH_SIZE')):
+        if user_args[dest] < 1:
+            parser.error(option + ' must be at least 1')
+    if user_args['TIME_BUDGET'] and user_args['RUN_MODE'] == 'pipeline':
+        parser.error('--time-budget cannot be used with --run-mode pipeline')
 
     # Get the SIGNALFX_API_TOKEN from environment variables
     try:
@@ -350,10 +1800,26 @@ def main(argv):
     user_args.pop('ENV_VARIABLE_NAME')
     user_args['SIGNALFX_API_TOKEN'] = SIGNALFX_API_TOKEN
     use_cron = user_args.pop('use_cron', False)
+    chef_configs = user_args.pop('CHEF_CONFIGS') or [None]
 
-    m = ChefMetadata(**user_args)
+    if len(chef_configs) > 1:
+        m = MultiOrgChefMetadata(chef_configs, **user_args)
+    else:
+        m = ChefMetadata(CHEF_CONFIG=chef_configs[0], **user_args)
+    # Hold a lock on the state file for as long as the program runs
+    lock = RunLock(user_args['STATE_FILE'] + '.lock')
+    if not lock.acquire():
+        m.logger.warning('Another run is using ' + user_args['STATE_FILE'] +
+                         ', exiting')
+        if use_cron:
+            return
+        sys.exit(1)
     if use_cron:
         m.run()
+    elif user_args['NOTIFY_PORT'] is not None:
+        m.run_daemon()
+    elif m.RUN_MODE == 'adaptive':
+        m.run_adaptive()
     else:
         while True:
             m.run()
@@ -0,0 +1,176 @@
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class _PlanNode(object):
+    """
+    A token of the attribute paths in the extraction plan
+    """
+    __slots__ = ('children', 'targets', 'attributes')
+
+    def __init__(self):
+        # list of (token, _PlanNode), walked in order
+        self.children = []
+        # list of (attribute, property name) ending at this token
+        self.targets = []
+        # all the attributes at or below this token
+        self.attributes = []
+
+    def child(self, token):
+        for child_token, child in self.children:
+            if child_token == token:
+                return child
+        child = _PlanNode()
+        self.children.append((token, child))
+        return child
+
+
+class ExtractionPlan(object):
+    """
+    The attributes listed in the configuration file compiled into a
+    prefix tree, so that attributes sharing a prefix, such as
+    languages.python.version and languages.ruby.version, walk the node
+    object along the shared prefix only once
+    """
+
+    def __init__(self, attributes, adjust_attribute_name):
+        self.attributes = attributes
+        # list of (attribute, property name) in configuration order
+        self.targets = []
+        # the properties of the node records built with this plan, shared
+        # by all the records: names in order and name to position
+        self.record_names = ('chef_environment',)
+        self.record_index = {'chef_environment': 0}
+        self.root = _PlanNode()
+        for attribute in attributes:
+            target = (attribute, adjust_attribute_name(attribute))
+            self.targets.append(target)
+            if target[1] not in self.record_index:
+                self.record_index[target[1]] = len(self.record_names)
+                self.record_names += (target[1],)
+            plan_node = self.root
+            for token in attribute.split('.'):
+                plan_node = plan_node.child(token)
+                plan_node.attributes.append(attribute)
+            plan_node.targets.append(target)
+
+    def extract(self, node_details, missing=None):
+        """
+        Walk the node object along the plan
+
+        return: list of (attribute, property name, raw value) of the
+        attributes found. The attributes which are not found are appended
+        to the missing list if one is given.
+        """
+        found = []
+        stack = [(self.root, node_details)]
+        while stack:
+            plan_node, value = stack.pop()
+            for attribute, property_name in plan_node.targets:
+                found.append((attribute, property_name, value))
+            for token, child in plan_node.children:
+                try:
+                    child_value = value[token]
+                except Exception:
+                    if missing is not None:
+                        missing.extend(child.attributes)
+                    continue
+                stack.append((child, child_value))
+        return found
+
+    def new_record(self, unique_id, properties, interner):
+        """
+        Build a node record from a dictionary of property name to value,
+        interning the values
+
+        return: NodeRecord
+        """
+        values = [None] * len(self.record_names)
+        for property_name, value in properties.items():
+            values[self.record_index[property_name]] = interner.intern(value)
+        return NodeRecord(unique_id, self, tuple(values))
+
+
+class ValueInterner(object):
+    """
+    Share one copy of every distinct value, since roles, environments or
+    versions repeat across thousands of nodes
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def intern(self, value):
+        """
+        return: the shared copy of the value
+        """
+        if value is None:
+            return None
+        return self.values.setdefault(value, value)
+
+
+class NodeRecord(object):
+    """
+    The metadata of a node as a tuple of values laid out by its extraction
+    plan, read like the dictionary of property name to value it replaces,
+    with the chefUniqueId under the 'chefUniqueId' key
+
+    Records are read-only, so they are shared instead of copied
+    """
+    __slots__ = ('unique_id', 'plan', 'values')
+
+    def __init__(self, unique_id, plan, values):
+        self.unique_id = unique_id
+        self.plan = plan
+        self.values = values
+
+    def __getitem__(self, key):
+        if key == 'chefUniqueId':
+            return self.unique_id
+        index = self.plan.record_index.get(key)
+        if index is None or self.values[index] is None:
+            raise KeyError(key)
+        return self.values[index]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping) and not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def items(self):
+        """
+        return: list of (property name, value), chefUniqueId first
+        """
+        items = [('chefUniqueId', self.unique_id)]
+        for index, value in enumerate(self.values):
+            if value is not None:
+                items.append((self.plan.record_names[index], value))
+        return items
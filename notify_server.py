@@ -0,0 +1,144 @@
+import json
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+# Keys holding the node name and the organization in notification bodies,
+# as sent by Chef report handlers and Chef Automate webhooks
+NODE_NAME_KEYS = ('node_name', 'node', 'name')
+ORGANIZATION_KEYS = ('organization', 'organization_name')
+MAX_BODY_SIZE = 1024 * 1024
+try:
+    STRING_TYPES = (str, unicode)  # noqa: F821
+except NameError:
+    STRING_TYPES = (str,)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class NotificationServer(object):
+    """
+    Small HTTP listener accepting notifications that a node converged
+
+        POST /nodes/<node name>[?organization=<organization>]
+        POST /notify with a JSON body holding the node name in node_name,
+        node or name and optionally the organization in organization or
+        organization_name
+
+    callback(node_name, organization) is called for every notification,
+    with organization None if it is not given, and returns False if the
+    node cannot be synced by this collector
+    """
+
+    def __init__(self, address, port, callback, logger):
+        self.callback = callback
+        self.logger = logger
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.reply(400, {'error': 'invalid Content-Length'})
+                    return
+                if length > MAX_BODY_SIZE:
+                    self.reply(413, {'error': 'body too large'})
+                    return
+                body = self.rfile.read(length) if length else b''
+                status, data = server.handle(self.path, body)
+                self.reply(status, data)
+
+            def reply(self, status, data):
+                payload = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                server.logger.debug('Notification listener: ' +
+                                    format % args)
+
+        self.httpd = _ThreadingHTTPServer((address, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """
+        Serve the notifications in a background thread
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='notify-listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, path, body):
+        """
+        Parse a notification and pass it to the callback
+
+        return: tuple of (HTTP status code, JSON-serializable body)
+        """
+        url = urlparse(path)
+        query = dict((key, values[0])
+                     for key, values in parse_qs(url.query).items())
+        organization = query.get('organization')
+        if url.path.startswith('/nodes/'):
+            node_name = unquote(url.path[len('/nodes/'):])
+        elif url.path == '/notify':
+            try:
+                data = json.loads(body.decode('utf-8'))
+            except ValueError:
+                return 400, {'error': 'body is not valid JSON'}
+            if not isinstance(data, dict):
+                return 400, {'error': 'body is not a JSON object'}
+            node_name = first_value(data, NODE_NAME_KEYS)
+            organization = first_value(data, ORGANIZATION_KEYS) or \
+                organization
+        else:
+            return 404, {'error': 'unknown path'}
+        if not is_name(node_name):
+            return 400, {'error': 'node name is missing or not a string'}
+        if organization is not None and not is_name(organization):
+            return 400, {'error': 'organization is not a string'}
+        if not self.callback(node_name, organization):
+            return 404, {'error': 'node is not synced by this collector'}
+        return 202, {'node_name': node_name}
+
+
+def is_name(value):
+    """
+    return: True if the value is a non-empty string
+    """
+    return isinstance(value, STRING_TYPES) and len(value) > 0
+
+
+def first_value(data, keys):
+    """
+    return: the value of the first of the keys found in data, or None
+    """
+    for key in keys:
+        if data.get(key):
+            return data[key]
+    return None
@@ -0,0 +1,134 @@
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_TIMEOUT = 1.0
+
+_END = object()
+
+
+class Stage(object):
+    """
+    A step of the pipeline, run by one or more threads
+
+    function(item, emit) is called for every item, or function(items, emit)
+    for every batch of up to batch_size items if batch_size is set. It
+    passes its results to the next stage by calling emit(result).
+    """
+
+    def __init__(self, name, function, workers=1, batch_size=None,
+                 batch_timeout=DEFAULT_BATCH_TIMEOUT):
+        if workers < 1:
+            raise ValueError('Stage ' + name + ' needs at least one worker')
+        if batch_size is not None and batch_size < 1:
+            raise ValueError('Stage ' + name + ' needs a batch size of at ' +
+                             'least 1')
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+
+class Pipeline(object):
+    """
+    Run stages concurrently, connected by bounded queues, so that an item
+    moves on to the next stage as soon as it is processed and a slow stage
+    holds back the ones before it instead of letting items pile up
+
+    An error raised for an item (or batch) is logged and the item dropped,
+    so one bad node does not stop the others
+    """
+
+    def __init__(self, stages, logger, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.logger = logger
+        self.queues = [queue.Queue(queue_size) for stage in stages]
+        self.remaining_workers = [stage.workers for stage in stages]
+        self.lock = threading.Lock()
+
+    def run(self, items):
+        """
+        Feed the items to the first stage and wait until the last stage
+        has processed all of them
+        """
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(index,),
+                                          name=stage.name + '-' + str(worker))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in items:
+                self.queues[0].put(item)
+        finally:
+            self.queues[0].put(_END)
+            for thread in threads:
+                thread.join()
+
+    def work(self, index):
+        """
+        Process the items of the stage at the given index until the end
+        of the input is reached
+        """
+        stage = self.stages[index]
+        if index + 1 < len(self.stages):
+            emit = self.queues[index + 1].put
+        else:
+            def emit(item):
+                pass
+        while True:
+            items, ended = self.take(index)
+            if items:
+                try:
+                    if stage.batch_size:
+                        stage.function(items, emit)
+                    else:
+                        stage.function(items[0], emit)
+                except Exception:
+                    self.logger.error('Error in pipeline stage ' +
+                                      stage.name, exc_info=True)
+            if ended:
+                break
+        # Let the sibling workers see the end too, and tell the next stage
+        # once the last worker of this stage is done
+        self.queues[index].put(_END)
+        with self.lock:
+            self.remaining_workers[index] -= 1
+            last = self.remaining_workers[index] == 0
+        if last and index + 1 < len(self.stages):
+            self.queues[index + 1].put(_END)
+
+    def take(self, index):
+        """
+        Take the next item, or the next batch of items for a batch stage,
+        from the queue of the stage at the given index
+
+        return: tuple of (list of items, whether the end was reached)
+        """
+        stage = self.stages[index]
+        item = self.queues[index].get()
+        if item is _END:
+            return [], True
+        items = [item]
+        if not stage.batch_size:
+            return items, False
+        deadline = time.time() + stage.batch_timeout
+        while len(items) < stage.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queues[index].get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _END:
+                return items, True
+            items.append(item)
+        return items, False
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+import heapq
+import json
+import threading
+import time
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+DEFAULT_TOP = 10
+
+
+class NodeProfiler(object):
+    """
+    Time the Chef and SignalFx calls made for each node and measure the
+    size of each node object, keeping the slowest calls and the largest
+    nodes for a report
+
+    A disabled profiler records nothing, so the calls can stay wrapped
+    """
+
+    def __init__(self, enabled=True, top=DEFAULT_TOP, clock=time.time):
+        self.enabled = enabled
+        self.top = top
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the measurements of the previous run
+        """
+        with self.lock:
+            # min-heaps of the top entries, the smallest one first
+            self.slowest_calls = []
+            self.largest_nodes = []
+            # node name to the total seconds of its calls
+            self.node_seconds = {}
+
+    @contextmanager
+    def call(self, kind, node_name=None):
+        """
+        Time the enclosed block as a call of the given kind, made for the
+        given node if any
+        """
+        if not self.enabled:
+            yield
+            return
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record_call(kind, node_name, self.clock() - started)
+
+    def record_call(self, kind, node_name, seconds):
+        """
+        Record the duration of a call
+        """
+        with self.lock:
+            self.push(self.slowest_calls, (seconds, kind, node_name or ''))
+            if node_name is not None:
+                self.node_seconds[node_name] = \
+                    self.node_seconds.get(node_name, 0) + seconds
+
+    def record_size(self, node_name, node_data):
+        """
+        Record the size of the node object as JSON
+        """
+        if not self.enabled:
+            return
+        size = len(json.dumps(node_data, default=to_builtin))
+        with self.lock:
+            self.push(self.largest_nodes, (size, node_name))
+
+    def push(self, heap, entry):
+        if len(heap) < self.top:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def report(self):
+        """
+        return: text report of the slowest nodes and calls and of the
+        largest nodes
+        """
+        with self.lock:
+            slowest_nodes = heapq.nlargest(
+                self.top, self.node_seconds.items(),
+                key=lambda item: item[1])
+            slowest_calls = sorted(self.slowest_calls, reverse=True)
+            largest_nodes = sorted(self.largest_nodes, reverse=True)
+        lines = ['Slowest nodes (seconds of all their calls)']
+        for node_name, seconds in slowest_nodes:
+            lines.append('%10.3f  %s' % (seconds, node_name))
+        lines.append('Slowest calls (seconds)')
+        for seconds, kind, node_name in slowest_calls:
+            lines.append('%10.3f  %s  %s' % (seconds, kind, node_name))
+        lines.append('Largest nodes (bytes as JSON)')
+        for size, node_name in largest_nodes:
+            lines.append('%10d  %s' % (size, node_name))
+        return '\n'.join(lines)
+
+
+def to_builtin(value):
+    """
+    Convert the mappings of PyChef, such as NodeAttributes, for json.dumps
+
+    return: dictionary or string
+    """
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
@@ -0,0 +1,106 @@
+import heapq
+import random
+import time
+
+BACKOFF_FACTOR = 2
+JITTER = 0.25
+
+
+class AdaptiveScheduler(object):
+    """
+    Decide when each node is synced next, with a priority queue of due
+    times
+
+    A node that changed is revisited after min_interval, and a node that
+    did not change waits twice as long as the previous time, up to
+    max_interval. New nodes are spread over min_interval and every delay
+    is jittered, so that the work does not arrive in bursts
+    """
+
+    def __init__(self, min_interval, max_interval, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.clock = clock
+        # heap of (due time, node name), with stale entries skipped
+        self.queue = []
+        # node name to its current due time and interval
+        self.due = {}
+        self.intervals = {}
+
+    def __len__(self):
+        return len(self.due)
+
+    def update(self, node_names, converged=()):
+        """
+        Track the given nodes, forgetting the ones which are gone, and
+        make the known nodes which converged since they were last synced
+        due now
+        """
+        now = self.clock()
+        node_names = set(node_names)
+        for node_name in list(self.due):
+            if node_name not in node_names:
+                del self.due[node_name]
+                del self.intervals[node_name]
+        for node_name in converged:
+            if node_name in self.due:
+                self.intervals[node_name] = self.min_interval
+                self.schedule(node_name, now)
+        for node_name in node_names:
+            if node_name not in self.due:
+                self.intervals[node_name] = self.min_interval
+                self.schedule(node_name, now + random.uniform(
+                    0, self.min_interval))
+            elif self.due[node_name] is None:
+                # popped but never rescheduled, as its sync failed
+                self.schedule(node_name, now)
+
+    def reschedule(self, node_name, changed):
+        """
+        Schedule the next sync of a node which was just synced, backing
+        off if it did not change
+        """
+        if node_name not in self.due:
+            return
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals[node_name] * BACKOFF_FACTOR,
+                           self.max_interval)
+        self.intervals[node_name] = interval
+        self.schedule(node_name, self.clock() + interval *
+                      random.uniform(1 - JITTER, 1 + JITTER))
+
+    def schedule(self, node_name, due):
+        self.due[node_name] = due
+        heapq.heappush(self.queue, (due, node_name))
+
+    def pop_due(self, limit):
+        """
+        return: list of up to limit node names which are due
+        """
+        now = self.clock()
+        node_names = []
+        while self.queue and len(node_names) < limit:
+            due, node_name = self.queue[0]
+            if self.due.get(node_name) != due:
+                heapq.heappop(self.queue)
+                continue
+            if due > now:
+                break
+            heapq.heappop(self.queue)
+            # Due again only once rescheduled
+            self.due[node_name] = None
+            node_names.append(node_name)
+        return node_names
+
+    def next_due(self):
+        """
+        return: the earliest due time, or None if no node is scheduled
+        """
+        while self.queue:
+            due, node_name = self.queue[0]
+            if self.due.get(node_name) == due:
+                return due
+            heapq.heappop(self.queue)
+        return None
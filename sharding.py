@@ -0,0 +1,28 @@
+import hashlib
+
+_JUMP_MULTIPLIER = 2862933555777941757
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def jump_consistent_hash(key, num_buckets):
+    """
+    Map a 64-bit key to one of num_buckets buckets with the jump consistent
+    hash of Lamping and Veach: going from N to N + 1 buckets only moves
+    about 1/(N + 1) of the keys, all of them to the new bucket
+
+    return: bucket index between 0 and num_buckets - 1
+    """
+    bucket, jump = -1, 0
+    while jump < num_buckets:
+        bucket = jump
+        key = (key * _JUMP_MULTIPLIER + 1) & _UINT64_MASK
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_of(node_name, shard_count):
+    """
+    return: index of the shard owning the node, the same in every process
+    """
+    digest = hashlib.md5(node_name.encode('utf-8')).hexdigest()
+    return jump_consistent_hash(int(digest[:16], 16), shard_count)
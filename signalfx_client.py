@@ -0,0 +1,176 @@
+from email.utils import mktime_tz, parsedate_tz
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30
+DEFAULT_TIMEOUT = 30
+
+
+class SignalFxError(Exception):
+    """
+    Raised when a request to SignalFx fails after all the retries
+    """
+    pass
+
+
+class TokenBucket(object):
+    """
+    Client-side rate limiter allowing `rate` requests per second on
+    average and bursts of up to `burst` requests
+    """
+
+    def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated_at = clock()
+        self.paused_until = 0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # Reserve the token now and sleep outside the lock, so that
+            # concurrent callers queue up behind each other
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate,
+                       self.paused_until - now)
+        if wait > 0:
+            self.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back every caller for the given number of seconds, as asked
+        by a Retry-After header
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    self.clock() + seconds)
+
+
+class SignalFxClient(object):
+    """
+    Send requests to SignalFx through a pool of keep-alive connections,
+    retrying on connection errors, 5xx and 429 responses with exponential
+    backoff and jitter
+    """
+
+    def __init__(self, token, pool_size=10, rate_limit=0,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, timeout=DEFAULT_TIMEOUT,
+                 logger=None, sleep=time.sleep, observer=None):
+        self.token = token
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.logger = logger
+        self.sleep = sleep
+        # called with (method, url, seconds) after every attempt
+        self.observer = observer
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = None
+        if rate_limit > 0:
+            self.limiter = TokenBucket(rate_limit, max(1, rate_limit),
+                                       sleep=sleep)
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request, see request()
+        """
+        return self.request('GET', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        """
+        Send a PATCH request, see request()
+        """
+        return self.request('PATCH', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Send a POST request, see request()
+        """
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, headers=None, **kwargs):
+        """
+        Send the request, retrying it up to max_retries times
+
+        return: the response, which may still be a 4xx error
+        """
+        request_headers = {'X-SF-Token': self.token}
+        request_headers.update(headers or {})
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            retry_after = None
+            error = None
+            started = time.time()
+            try:
+                resp = self.session.request(method, url,
+                                            headers=request_headers,
+                                            **kwargs)
+            except requests.RequestException as e:
+                error = str(e)
+            finally:
+                if self.observer is not None:
+                    self.observer(method, url, time.time() - started)
+            if error is None:
+                if resp.status_code != 429 and resp.status_code < 500:
+                    return resp
+                error = 'HTTP ' + str(resp.status_code)
+                retry_after = self.parse_retry_after(
+                    resp.headers.get('Retry-After'))
+            if attempt >= self.max_retries:
+                raise SignalFxError(method + ' ' + url + ' failed after ' +
+                                    str(attempt + 1) + ' attempts: ' + error)
+            if retry_after is not None:
+                delay = retry_after
+                if self.limiter is not None:
+                    self.limiter.pause(delay)
+            else:
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if self.logger is not None:
+                self.logger.warning(method + ' ' + url + ' failed (' +
+                                    error + '), retrying in ' +
+                                    '%.1f' % delay + ' seconds')
+            self.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Parse a Retry-After header given in seconds or as an HTTP date
+
+        return: number of seconds or None
+        """
+        if not value:
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
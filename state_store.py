@@ -0,0 +1,313 @@
+import json
+import os
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class StateStore(object):
+    """
+    Store the metadata sent to SignalFx in previous runs, keyed by
+    chefUniqueId, in a SQLite database
+
+    Every commit is a single transaction, so a crash in the middle of a
+    write leaves the previous state intact
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS nodes ('
+                'unique_id TEXT PRIMARY KEY, '
+                'metadata TEXT NOT NULL, '
+                'fingerprint TEXT)')
+            columns = [row[1] for row in self.connection.execute(
+                'PRAGMA table_info(nodes)')]
+            if 'fingerprint' not in columns:
+                self.connection.execute(
+                    'ALTER TABLE nodes ADD COLUMN fingerprint TEXT')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS objectids ('
+                'unique_id TEXT PRIMARY KEY, '
+                'object_id TEXT, '
+                'fetched_at REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS cursors ('
+                'name TEXT PRIMARY KEY, '
+                'position TEXT NOT NULL)')
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        with self.lock:
+            self.connection.close()
+
+    def get(self, unique_id):
+        """
+        Look up the metadata saved for the given chefUniqueId
+
+        return: dictionary of metadata or None
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT metadata FROM nodes WHERE unique_id = ?',
+                (unique_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def unique_ids(self):
+        """
+        return: set of all the chefUniqueIds in the store
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT unique_id FROM nodes').fetchall()
+        return set(row[0] for row in rows)
+
+    def fingerprints(self):
+        """
+        return: dictionary of chefUniqueId to the fingerprint saved with
+        its metadata
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT unique_id, fingerprint FROM nodes '
+                'WHERE fingerprint IS NOT NULL').fetchall()
+        return dict(rows)
+
+    def is_empty(self):
+        """
+        return: True if nothing was saved yet
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM nodes LIMIT 1').fetchone()
+        return row is None
+
+    def commit(self, nodes_metadata, fingerprints=None):
+        """
+        Save the metadata of the given nodes in one transaction, along with
+        their fingerprint if one is given in the fingerprints dictionary
+        Only the nodes whose metadata or fingerprint differs from the
+        stored one are written
+
+        return: number of nodes written
+        """
+        fingerprints = fingerprints or {}
+        written = 0
+        with self.lock:
+            with self.connection:
+                for node_information in nodes_metadata:
+                    unique_id = node_information['chefUniqueId']
+                    metadata = self.serialize(node_information)
+                    fingerprint = fingerprints.get(unique_id)
+                    cursor = self.connection.execute(
+                        'INSERT OR IGNORE INTO nodes '
+                        '(unique_id, metadata, fingerprint) '
+                        'VALUES (?, ?, ?)', (unique_id, metadata, fingerprint))
+                    if cursor.rowcount == 0 and fingerprint is None:
+                        cursor = self.connection.execute(
+                            'UPDATE nodes SET metadata = ? '
+                            'WHERE unique_id = ? AND metadata != ?',
+                            (metadata, unique_id, metadata))
+                    elif cursor.rowcount == 0:
+                        cursor = self.connection.execute(
+                            'UPDATE nodes SET metadata = ?, fingerprint = ? '
+                            'WHERE unique_id = ? AND '
+                            '(metadata != ? OR fingerprint IS NOT ?)',
+                            (metadata, fingerprint, unique_id, metadata,
+                             fingerprint))
+                    written += cursor.rowcount
+        return written
+
+    def delete(self, unique_ids):
+        """
+        Delete the metadata of the given chefUniqueIds in one transaction
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    'DELETE FROM nodes WHERE unique_id = ?',
+                    [(unique_id,) for unique_id in unique_ids])
+
+    def get_cursor(self, name):
+        """
+        return: the position saved under the given cursor name, or None
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT position FROM cursors WHERE name = ?',
+                (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_cursor(self, name, position):
+        """
+        Save the position of the given cursor, or forget it if position
+        is None
+        """
+        with self.lock:
+            with self.connection:
+                if position is None:
+                    self.connection.execute(
+                        'DELETE FROM cursors WHERE name = ?', (name,))
+                else:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO cursors (name, position) '
+                        'VALUES (?, ?)', (name, position))
+
+    def import_pickle(self, pickle_file):
+        """
+        Import the metadata saved as a Python pickle by earlier versions,
+        if the store is still empty and the pickle file exists
+
+        return: number of nodes imported
+        """
+        if not os.path.exists(pickle_file) or not self.is_empty():
+            return 0
+        with open(pickle_file, 'rb') as input_pickle:
+            saved_metadata = pickle.load(input_pickle)
+        nodes_metadata = []
+        for unique_id, metadata in saved_metadata.items():
+            node_information = dict(metadata)
+            node_information['chefUniqueId'] = unique_id
+            nodes_metadata.append(node_information)
+        return self.commit(nodes_metadata)
+
+    @staticmethod
+    def serialize(node_information):
+        """
+        Serialize the node information without its chefUniqueId key
+
+        return: JSON string
+        """
+        metadata = dict((key, value)
+                        for key, value in node_information.items()
+                        if key != 'chefUniqueId')
+        return json.dumps(metadata, sort_keys=True)
+
+
+class ObjectIdCache(object):
+    """
+    Cache the SignalFx ObjectIDs of the chefUniqueId dimensions in the
+    state store, so that they are not looked up again on every run
+
+    A chefUniqueId without a dimension on SignalFx is cached as None for
+    a shorter time, since the dimension may appear once the node sends
+    its metrics
+    """
+
+    def __init__(self, store, ttl, negative_ttl, max_size, clock=time.time):
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.clock = clock
+
+    def lookup(self, unique_id):
+        """
+        Look up the cached ObjectID of the given chefUniqueId
+
+        return: tuple of (found, ObjectID or None)
+        """
+        with self.store.lock:
+            row = self.store.connection.execute(
+                'SELECT object_id, fetched_at FROM objectids '
+                'WHERE unique_id = ?', (unique_id,)).fetchone()
+        if row is None:
+            return False, None
+        object_id, fetched_at = row
+        ttl = self.ttl if object_id is not None else self.negative_ttl
+        if self.clock() - fetched_at >= ttl:
+            return False, None
+        return True, object_id
+
+    def put(self, unique_id, object_id):
+        """
+        Cache the ObjectID, or None if there is no dimension, of the given
+        chefUniqueId
+        The change is written to disk by the next flush
+        """
+        with self.store.lock:
+            self.store.connection.execute(
+                'INSERT OR REPLACE INTO objectids '
+                '(unique_id, object_id, fetched_at) VALUES (?, ?, ?)',
+                (unique_id, object_id, self.clock()))
+
+    def invalidate(self, unique_id):
+        """
+        Forget the ObjectID of the given chefUniqueId
+        """
+        with self.store.lock:
+            self.store.connection.execute(
+                'DELETE FROM objectids WHERE unique_id = ?', (unique_id,))
+
+    def flush(self):
+        """
+        Evict the expired entries and the oldest entries beyond max_size,
+        then write the cache to disk
+        """
+        now = self.clock()
+        with self.store.lock:
+            with self.store.connection:
+                connection = self.store.connection
+                connection.execute(
+                    'DELETE FROM objectids WHERE fetched_at <= ? OR '
+                    '(object_id IS NULL AND fetched_at <= ?)',
+                    (now - self.ttl, now - self.negative_ttl))
+                size = connection.execute(
+                    'SELECT COUNT(*) FROM objectids').fetchone()[0]
+                if size > self.max_size:
+                    connection.execute(
+                        'DELETE FROM objectids WHERE unique_id IN ('
+                        'SELECT unique_id FROM objectids '
+                        'ORDER BY fetched_at LIMIT ?)',
+                        (size - self.max_size,))
+
+
+class RunLock(object):
+    """
+    Exclusive lock on a file, so that two runs do not use the same state
+    file at the same time
+    The lock is released when the process exits, even if it is killed.
+    Without fcntl, on Windows, locking always succeeds
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        """
+        return: False if another process holds the lock
+        """
+        if fcntl is None:
+            return True
+        self.file = open(self.path, 'a')
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        """
+        Release the lock if it is held
+        """
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
@@ -0,0 +1,194 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+METRIC_PREFIX = 'chef_metadata.'
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class LatencyHistogram(object):
+    """
+    Count, sum, maximum and bucketed distribution of request latencies
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        """
+        Add a latency, in seconds
+        """
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def to_dict(self):
+        """
+        return: dictionary of the histogram, buckets keyed by upper bound
+        """
+        buckets = {}
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            buckets[str(bound)] = self.buckets[index]
+        buckets['+Inf'] = self.buckets[-1]
+        return {'count': self.count, 'sum': self.total,
+                'max': self.maximum, 'buckets': buckets}
+
+
+class Telemetry(object):
+    """
+    Record the phase durations, request latencies and node counters of
+    a sweep, and export them as SignalFx datapoints or as a stats file
+    """
+
+    def __init__(self, dimensions=None, clock=time.time):
+        self.dimensions = dimensions or {}
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last_sweep_end = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the measurements of the previous sweep
+        """
+        with self.lock:
+            self.phases = {}
+            self.requests = {}
+            self.counters = {}
+            self.sweep_start = None
+            self.sweep_duration = None
+            self.sweep_lag = None
+
+    def start_sweep(self):
+        """
+        Reset the measurements and record the start of a sweep
+        """
+        self.reset()
+        self.sweep_start = self.clock()
+
+    def end_sweep(self):
+        """
+        Record the duration of the sweep and the lag, the time since the
+        end of the previous sweep, which is how stale SignalFx can get
+        """
+        now = self.clock()
+        with self.lock:
+            self.sweep_duration = now - self.sweep_start
+            if self.last_sweep_end is not None:
+                self.sweep_lag = now - self.last_sweep_end
+            self.last_sweep_end = now
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as the given phase
+        """
+        started = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - started
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    @contextmanager
+    def request(self, endpoint):
+        """
+        Time the enclosed block as a request to the given endpoint
+        """
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.observe_request(endpoint, self.clock() - started)
+
+    def observe_request(self, endpoint, seconds):
+        """
+        Record the latency of a request to the given endpoint
+        """
+        with self.lock:
+            if endpoint not in self.requests:
+                self.requests[endpoint] = LatencyHistogram()
+            self.requests[endpoint].observe(seconds)
+
+    def increment(self, name, value=1):
+        """
+        Add the value to the given counter
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        return: dictionary of the measurements of the sweep
+        """
+        with self.lock:
+            return {
+                'timestamp': self.clock(),
+                'sweep_duration': self.sweep_duration,
+                'sweep_lag': self.sweep_lag,
+                'phases': dict(self.phases),
+                'counters': dict(self.counters),
+                'requests': dict((endpoint, histogram.to_dict())
+                                 for endpoint, histogram
+                                 in self.requests.items()),
+            }
+
+    def datapoints(self):
+        """
+        Convert the measurements into the body of a request to the
+        SignalFx /v2/datapoint ingest API
+
+        return: dictionary of gauge and counter datapoints
+        """
+        stats = self.snapshot()
+        timestamp = int(stats['timestamp'] * 1000)
+        gauges = []
+        counters = []
+
+        def add(datapoints, metric, value, **dimensions):
+            if value is None:
+                return
+            dimensions.update(self.dimensions)
+            datapoints.append({'metric': METRIC_PREFIX + metric,
+                               'value': value,
+                               'dimensions': dimensions,
+                               'timestamp': timestamp})
+
+        add(gauges, 'sweep.duration', stats['sweep_duration'])
+        add(gauges, 'sweep.lag', stats['sweep_lag'])
+        for name, seconds in stats['phases'].items():
+            add(gauges, 'phase.duration', seconds, phase=name)
+        for name, value in stats['counters'].items():
+            add(counters, name, value)
+        for endpoint, histogram in stats['requests'].items():
+            add(counters, 'request.count', histogram['count'],
+                endpoint=endpoint)
+            add(counters, 'request.latency.sum', histogram['sum'],
+                endpoint=endpoint)
+            add(gauges, 'request.latency.max', histogram['max'],
+                endpoint=endpoint)
+            for bound, count in histogram['buckets'].items():
+                add(counters, 'request.latency.bucket', count,
+                    endpoint=endpoint, le=bound)
+        return {'gauge': gauges, 'counter': counters}
+
+    def write_stats_file(self, path):
+        """
+        Write the measurements of the sweep as JSON, replacing the file
+        atomically
+        """
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(temporary_path, path)
@@ -0,0 +1,49 @@
+import unittest
+import benchmark
+
+
+class Test_benchmark(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        """
+        Check if a sweep over the fake servers sends every node once and if
+        the next sweep only sends the converged nodes
+        """
+        results = benchmark.run_benchmark(20, runs=2, change_rate=0.1,
+                                          payload_size=100)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['requests']['GET /nodes/<name>'], 20)
+        self.assertEqual(
+            results[0]['requests']['PATCH /v1/dimension/<id>'], 20)
+        self.assertEqual(
+            results[1]['requests']['PATCH /v1/dimension/<id>'], 2)
+        self.assertTrue(results[0]['bytes'] > 0)
+        self.assertIn('sweep', benchmark.format_results(results))
+        self.assertEqual(results[1]['error'], None)
+
+    def test_run_benchmark_with_errors(self):
+        """
+        Check if sweeps failing on injected errors are recorded instead of
+        ending the benchmark, in both collection modes
+        """
+        for collection_mode in ('nodes', 'partial-search'):
+            results = benchmark.run_benchmark(
+                10, runs=2, payload_size=100, chef_error_rate=1,
+                COLLECTION_MODE=collection_mode)
+            self.assertEqual(len(results), 2)
+            self.assertTrue(results[0]['error'].startswith('SystemExit'))
+            self.assertIn('SystemExit', benchmark.format_results(results))
+        results = benchmark.run_benchmark(20, runs=1, payload_size=100,
+                                          chef_error_rate=0.2)
+        self.assertEqual(len(results), 1)
+
+    def test_run_isolated(self):
+        """
+        Check if a fleet size can be measured in a child process
+        """
+        results = benchmark.run_isolated(5, runs=1, payload_size=100)
+        self.assertEqual(results[0]['requests']['GET /nodes/<name>'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,13 @@
 import unittest
 import collect_chef_metadata
+import json
 import os
+import pstats
+import requests
+import shutil
+import sys
+import tempfile
+import time
 
 
 class Test_collect_chef_metadata(unittest.TestCase):
@@ -22,12 +29,46 @@ class Test_collect_chef_metadata(unittest.TestCase):
                          collect_chef_metadata.DEFAULT_SIGNALFX_REST_API)
         self.assertEqual(args['PICKLE_FILE'],
                          collect_chef_metadata.DEFAULT_PICKLE_FILE)
+        self.assertEqual(args['STATE_FILE'],
+                         collect_chef_metadata.DEFAULT_STATE_FILE)
+        self.assertEqual(args['OBJECTID_TTL'],
+                         collect_chef_metadata.DEFAULT_OBJECTID_TTL)
         self.assertEqual(args['SLEEP_DURATION'],
                          collect_chef_metadata.DEFAULT_SLEEP_DURATION)
         self.assertEqual(args['ENV_VARIABLE_NAME'],
                          collect_chef_metadata.DEFAULT_ENV_VARIABLE_NAME)
         self.assertEqual(args['LOG_HANDLER'],
                          collect_chef_metadata.DEFAULT_LOG_HANDLER)
+        self.assertEqual(args['COLLECTION_MODE'],
+                         collect_chef_metadata.DEFAULT_COLLECTION_MODE)
+        self.assertEqual(args['SEARCH_ROWS'],
+                         collect_chef_metadata.DEFAULT_SEARCH_ROWS)
+        self.assertEqual(args['CHEF_CONCURRENCY'],
+                         collect_chef_metadata.DEFAULT_CHEF_CONCURRENCY)
+        self.assertEqual(args['TELEMETRY'], False)
+        self.assertEqual(args['SIGNALFX_INGEST_API'],
+                         collect_chef_metadata.DEFAULT_SIGNALFX_INGEST_API)
+        self.assertEqual(args['STATS_FILE'], None)
+        self.assertEqual(args['SHARD_INDEX'],
+                         collect_chef_metadata.DEFAULT_SHARD_INDEX)
+        self.assertEqual(args['SHARD_COUNT'],
+                         collect_chef_metadata.DEFAULT_SHARD_COUNT)
+        self.assertEqual(args['RUN_MODE'],
+                         collect_chef_metadata.DEFAULT_RUN_MODE)
+        self.assertEqual(args['MAX_INTERVAL'],
+                         collect_chef_metadata.DEFAULT_MAX_INTERVAL)
+        self.assertEqual(args['CHEF_CONFIGS'], None)
+        self.assertEqual(args['SIGNALFX_CONCURRENCY'],
+                         collect_chef_metadata.DEFAULT_SIGNALFX_CONCURRENCY)
+        self.assertEqual(args['UPDATE_MODE'],
+                         collect_chef_metadata.DEFAULT_UPDATE_MODE)
+        self.assertEqual(args['NOTIFY_PORT'], None)
+        self.assertEqual(args['NOTIFY_ADDRESS'],
+                         collect_chef_metadata.DEFAULT_NOTIFY_ADDRESS)
+        self.assertEqual(args['TIME_BUDGET'], None)
+        self.assertEqual(args['PROFILE'], None)
+        self.assertEqual(args['PROFILE_TOP'],
+                         collect_chef_metadata.DEFAULT_PROFILE_TOP)
 
     def test_argument_parser_for_custom_parameters(self):
         """
@@ -40,9 +81,30 @@ class Test_collect_chef_metadata(unittest.TestCase):
                        '--signalfx-rest-api',
                        'http://lab-api.corp.signalfuse.com:8080',
                        '--pickle-file', 'my_pk_metadata.pk',
+                       '--state-file', 'my_state.db',
+                       '--objectid-ttl', '3600',
                        '--sleep-duration', '10',
                        '--env-variable-name', 'MY_SIGNALFX_API_TOKEN',
-                       '--log-handler', 'stdout'
+                       '--log-handler', 'stdout',
+                       '--collection-mode', 'partial-search',
+                       '--search-rows', '500',
+                       '--chef-concurrency', '8',
+                       '--telemetry',
+                       '--signalfx-ingest-api', 'http://localhost:8080',
+                       '--stats-file', '/tmp/stats.json',
+                       '--shard-index', '2',
+                       '--shard-count', '3',
+                       '--run-mode', 'adaptive',
+                       '--max-interval', '7200',
+                       '--chef-config', '/etc/chef/acme.rb',
+                       '--chef-config', 'https://chef/organizations/globex',
+                       '--signalfx-concurrency', '20',
+                       '--update-mode', 'json',
+                       '--notify-port', '8181',
+                       '--notify-address', '0.0.0.0',
+                       '--time-budget', '240',
+                       '--profile', '/tmp/run.prof',
+                       '--profile-top', '5'
                        ]
         parser = collect_chef_metadata.get_argument_parser()
         args = vars(parser.parse_args(custom_argv))
@@ -52,9 +114,44 @@ class Test_collect_chef_metadata(unittest.TestCase):
         self.assertEqual(args['SIGNALFX_REST_API'],
                          'http://lab-api.corp.signalfuse.com:8080')
         self.assertEqual(args['PICKLE_FILE'], 'my_pk_metadata.pk')
+        self.assertEqual(args['STATE_FILE'], 'my_state.db')
+        self.assertEqual(args['OBJECTID_TTL'], 3600)
         self.assertEqual(args['SLEEP_DURATION'], 10)
         self.assertEqual(args['ENV_VARIABLE_NAME'], 'MY_SIGNALFX_API_TOKEN')
         self.assertEqual(args['LOG_HANDLER'], 'stdout')
+        self.assertEqual(args['COLLECTION_MODE'], 'partial-search')
+        self.assertEqual(args['SEARCH_ROWS'], 500)
+        self.assertEqual(args['CHEF_CONCURRENCY'], 8)
+        self.assertEqual(args['TELEMETRY'], True)
+        self.assertEqual(args['SIGNALFX_INGEST_API'], 'http://localhost:8080')
+        self.assertEqual(args['STATS_FILE'], '/tmp/stats.json')
+        self.assertEqual(args['SHARD_INDEX'], 2)
+        self.assertEqual(args['SHARD_COUNT'], 3)
+        self.assertEqual(args['RUN_MODE'], 'adaptive')
+        self.assertEqual(args['MAX_INTERVAL'], 7200)
+        self.assertEqual(args['CHEF_CONFIGS'],
+                         ['/etc/chef/acme.rb',
+                          'https://chef/organizations/globex'])
+        self.assertEqual(args['SIGNALFX_CONCURRENCY'], 20)
+        self.assertEqual(args['UPDATE_MODE'], 'json')
+        self.assertEqual(args['NOTIFY_PORT'], 8181)
+        self.assertEqual(args['NOTIFY_ADDRESS'], '0.0.0.0')
+        self.assertEqual(args['TIME_BUDGET'], 240)
+        self.assertEqual(args['PROFILE'], '/tmp/run.prof')
+        self.assertEqual(args['PROFILE_TOP'], 5)
+
+    def test_main_rejects_invalid_arguments(self):
+        """
+        Check if concurrencies and batch sizes below 1 and a time budget
+        in the pipeline run mode are refused before anything runs
+        """
+        os.environ['SIGNALFX_API_TOKEN'] = 'abcdefghijk'
+        for argv in (['--chef-concurrency', '0'],
+                     ['--signalfx-concurrency', '0'],
+                     ['--objectid-batch-size', '0'],
+                     ['--time-budget', '60', '--run-mode', 'pipeline'],
+                     ['--shard-index', '1']):
+            self.assertRaises(SystemExit, collect_chef_metadata.main, argv)
 
     def test_check_property_name_syntax(self):
         """
@@ -120,6 +217,705 @@ class Test_collect_chef_metadata(unittest.TestCase):
                                                         }
                                                        }), None)
 
+    def test_collect_metadata_from_chef_search(self):
+        """
+        Check if the partial search mode pages through all the nodes and
+        stores the selected attributes the same way as the nodes mode
+        """
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            COLLECTION_MODE='partial-search',
+            SEARCH_ROWS=2)
+        m.config = ['roles', 'languages.python.version']
+        rows = [{'data': {'name': 'node' + str(i),
+                          'chef_environment': 'prod',
+                          'roles': ['web', 'cache'],
+                          'languages.python.version':
+                          None if i == 2 else '2.7.8'}}
+                for i in range(3)]
+        requests_made = []
+
+        class FakeChefAPI(object):
+            def api_request(self, method, path, data=None):
+                requests_made.append((method, path))
+                if path == '':
+                    return {'name': 'org'}
+                start = int(path.split('start=')[1].split('&')[0])
+                return {'total': len(rows), 'start': start,
+                        'rows': rows[start:start + 2]}
+
+        m.api = FakeChefAPI()
+        m.collect_metadata_from_chef()
+        self.assertEqual(len(requests_made), 3)
+        self.assertEqual(requests_made[1][0], 'POST')
+        self.assertEqual(len(m.nodes_metadata), 3)
+        self.assertEqual(m.nodes_metadata[0],
+                         {'chefUniqueId': 'org_node0',
+                          'chef_environment': 'prod',
+                          'chef_roles': 'web$cache',
+                          'chef_languages_python_version': '2.7.8'})
+        self.assertNotIn('chef_languages_python_version',
+                         m.nodes_metadata[2])
+
+    def test_collect_node_information_concurrently(self):
+        """
+        Check if the concurrent collection keeps the order of the sequential
+        collection and skips the nodes which cannot be fetched
+        """
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            CHEF_CONCURRENCY=4)
+        m.organization = 'org'
+
+        def fetch_node_information(node_name):
+            if node_name == 'broken':
+                raise ValueError(node_name)
+            return {'chefUniqueId': 'org_' + node_name}
+
+        m.fetch_node_information = fetch_node_information
+        node_names = ['node' + str(i) for i in range(20)]
+        m.collect_node_information_concurrently(node_names + ['broken'])
+        self.assertEqual([n['chefUniqueId'] for n in m.nodes_metadata],
+                         ['org_' + node_name for node_name in node_names])
+
+    def test_collect_metadata_from_chef_skips_broken_nodes(self):
+        """
+        Check if the sequential collection skips the nodes which cannot be
+        fetched, like the concurrent collection
+        """
+        node_names = ['node0', 'broken', 'node1']
+
+        class FakeChefAPI(object):
+            def api_request(self, method, path, data=None):
+                if path == '':
+                    return {'name': 'org'}
+                return dict((node_name, '') for node_name in node_names)
+
+        def fetch_node_information(node_name):
+            if node_name == 'broken':
+                raise ValueError(node_name)
+            return {'chefUniqueId': 'org_' + node_name}
+
+        for concurrency in (1, 4):
+            m = collect_chef_metadata.ChefMetadata(
+                SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+                LOG_HANDLER='stdout',
+                CHEF_CONCURRENCY=concurrency)
+            m.api = FakeChefAPI()
+            m.fetch_node_information = fetch_node_information
+            m.collect_metadata_from_chef()
+            self.assertEqual(sorted(n['chefUniqueId']
+                                    for n in m.nodes_metadata),
+                             ['org_node0', 'org_node1'])
+
+    def test_send_metadata_to_signalfx_uses_objectid_cache(self):
+        """
+        Check if the ObjectID is looked up only for changed nodes and only
+        once, and if nodes without a dimension are reported as unsent
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.open_state_store()
+        m.state.commit([{'chefUniqueId': 'org_same', 'tags': 'a'}])
+        lookups = []
+        patches = []
+
+        class FakeResponse(object):
+            def __init__(self, rs=None):
+                self.status_code = 200
+                self.rs = rs
+
+            def json(self):
+                return {'rs': self.rs}
+
+        def get_signalfx_objectid(node_information, headers):
+            lookups.append(node_information['chefUniqueId'])
+            if node_information['chefUniqueId'] == 'org_missing':
+                return FakeResponse([])
+            return FakeResponse(['ABC'])
+
+        class FakeSignalFxClient(object):
+            def patch(self, url, params, headers):
+                patches.append((url, params))
+                return FakeResponse()
+
+        m.get_signalfx_objectid = get_signalfx_objectid
+        m.signalfx = FakeSignalFxClient()
+        for i in range(2):
+            self.assertTrue(m.send_metadata_to_signalfx(
+                {'chefUniqueId': 'org_same', 'tags': 'a'}))
+            self.assertTrue(m.send_metadata_to_signalfx(
+                {'chefUniqueId': 'org_new', 'tags': 'b'}))
+            self.assertFalse(m.send_metadata_to_signalfx(
+                {'chefUniqueId': 'org_missing', 'tags': 'c'}))
+        self.assertEqual(lookups, ['org_new', 'org_missing'])
+        self.assertEqual(len(patches), 2)
+        m.state.close()
+
+    def test_send_metadata_to_signalfx_on_client_error(self):
+        """
+        Check if a node is reported as unsent, without caching a missing
+        ObjectID, when Signalfx rejects the ObjectID query
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.open_state_store()
+
+        class FakeResponse(object):
+            status_code = 401
+            headers = {}
+
+            def json(self):
+                return {'message': 'Unauthorized'}
+
+        class FakeSession(object):
+            def __init__(self):
+                self.requests = []
+
+            def request(self, method, url, headers, **kwargs):
+                self.requests.append(method)
+                return FakeResponse()
+
+        m.signalfx.session = FakeSession()
+        self.assertFalse(m.send_metadata_to_signalfx(
+            {'chefUniqueId': 'org_node', 'tags': 'a'}))
+        self.assertEqual(m.signalfx.session.requests, ['GET'])
+        self.assertEqual(m.objectids.lookup('org_node'), (False, None))
+        m.state.close()
+
+    def test_send_all_metadata_as_json(self):
+        """
+        Check if the changes are sent concurrently as JSON bodies without
+        looking up ObjectIDs, and if only the nodes which could not be
+        updated are left unsent
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            UPDATE_MODE='json',
+            SIGNALFX_CONCURRENCY=4,
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.open_state_store()
+        patches = []
+
+        class FakeResponse(object):
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+        class FakeSignalFxClient(object):
+            def patch(self, url, json, headers):
+                patches.append((url, json))
+                if '/org_node%2F3/' in url:
+                    return FakeResponse(404)
+                return FakeResponse(200)
+
+        m.signalfx = FakeSignalFxClient()
+        m.prefetch_signalfx_objectids = None
+        m.nodes_metadata = [{'chefUniqueId': 'org_node/' + str(i),
+                             'chef_roles': 'web'} for i in range(10)]
+        changed = m.send_all_metadata_to_signalfx()
+        self.assertEqual(len(changed), 10)
+        self.assertEqual(m.unsent_ids, set(['org_node/3']))
+        url, body = sorted(patches)[0]
+        self.assertTrue(url.endswith(
+            '/v2/dimension/chefUniqueId/org_node%2F0/_/sfxagent'))
+        self.assertEqual(body, {'customProperties': {'chef_roles': 'web'},
+                                'tags': [], 'tagsToRemove': []})
+        self.assertEqual(m.objectids.lookup('org_node/3'), (True, None))
+        del patches[:]
+        self.assertFalse(m.send_metadata_to_signalfx(
+            {'chefUniqueId': 'org_node/3', 'chef_roles': 'web'}))
+        self.assertEqual(patches, [])
+        m.state.close()
+
+    def test_get_signalfx_objectids(self):
+        """
+        Check if chefUniqueIds are resolved with batched and escaped queries
+        and if the results are paged and mapped back to the chefUniqueIds
+        """
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            OBJECTID_BATCH_SIZE=2)
+        unique_ids = ['org_node0', 'org_node-1', 'org_node2', 'org_node3']
+        self.assertEqual(m.build_objectid_queries(unique_ids),
+                         [('chefUniqueId:(org_node0 OR org_node\\-1)',
+                           ['org_node0', 'org_node-1']),
+                          ('chefUniqueId:(org_node2 OR org_node3)',
+                           ['org_node2', 'org_node3'])])
+        queries = []
+
+        class FakeResponse(object):
+            def __init__(self, results):
+                self.results = results
+
+            def json(self):
+                return self.results
+
+        class FakeSignalFxClient(object):
+            def get(self, url, params, headers):
+                queries.append((params['query'], params['offset']))
+                rs = [{'chefUniqueId': unique_id,
+                       'sf_id': 'ID' + unique_id[-1]}
+                      for unique_id in unique_ids[:3] if
+                      unique_id.replace('-', '\\-') in params['query']]
+                return FakeResponse({'count': len(rs),
+                                     'rs': rs[params['offset']:
+                                              params['offset'] + 1]})
+
+        m.signalfx = FakeSignalFxClient()
+        m.OBJECTID_BATCH_SIZE = 1
+        self.assertEqual(len(m.build_objectid_queries(unique_ids)), 4)
+        m.OBJECTID_BATCH_SIZE = 2
+        self.assertEqual(m.get_signalfx_objectids(unique_ids, {}),
+                         {'org_node0': 'ID0', 'org_node-1': 'ID1',
+                          'org_node2': 'ID2', 'org_node3': None})
+        self.assertEqual([offset for query, offset in queries], [0, 1, 0])
+
+    def test_list_nodes_incremental(self):
+        """
+        Check if the incremental mode lists only the nodes whose fingerprint
+        changed while recording every node as present
+        """
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            INCREMENTAL=True)
+        m.organization = 'org'
+        m.config = ['roles']
+        rows = [{'data': {'name': 'node' + str(i),
+                          'chef_environment': 'prod',
+                          'ohai_time': 1000 + i}} for i in range(3)]
+
+        class FakeChefAPI(object):
+            def api_request(self, method, path, data=None):
+                return {'total': len(rows), 'start': 0, 'rows': rows}
+
+        m.api = FakeChefAPI()
+        self.assertEqual(list(m.list_nodes()), ['node0', 'node1', 'node2'])
+        m.saved_fingerprints = dict(m.fingerprints)
+        rows[1]['data']['ohai_time'] += 60
+        self.assertEqual(list(m.list_nodes()), ['node1'])
+        self.assertEqual(len(m.listed_ids), 3)
+        m.config = ['roles', 'tags']
+        self.assertEqual(len(list(m.list_nodes())), 3)
+
+    def test_list_nodes_sharded(self):
+        """
+        Check if the shards list disjoint slices of the nodes covering all
+        of them, and record only the chefUniqueIds of their own slice
+        """
+        node_names = ['node' + str(i) for i in range(30)]
+
+        class FakeChefAPI(object):
+            def api_request(self, method, path, data=None):
+                return dict((node_name, '') for node_name in node_names)
+
+        listed = []
+        for shard_index in range(3):
+            m = collect_chef_metadata.ChefMetadata(
+                SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+                LOG_HANDLER='stdout',
+                SHARD_INDEX=shard_index,
+                SHARD_COUNT=3)
+            m.organization = 'org'
+            m.api = FakeChefAPI()
+            shard = list(m.list_nodes())
+            self.assertTrue(shard)
+            self.assertEqual(m.listed_ids,
+                             set('org_' + node_name for node_name in shard))
+            listed.extend(shard)
+        self.assertEqual(sorted(listed), sorted(node_names))
+
+    def test_check_for_updates_in_metadata(self):
+        """
+        Check if only the changed properties are returned, without
+        modifying the collected metadata
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.open_state_store()
+        m.config = ['roles', 'tags']
+        plan = m.get_extraction_plan()
+        m.state.commit([{'chefUniqueId': 'org_node0',
+                         'chef_environment': 'prod',
+                         'chef_roles': 'web'}])
+        current = plan.new_record('org_node0',
+                                  {'chef_environment': 'prod',
+                                   'chef_roles': 'db',
+                                   'chef_tags': 'a'}, m.interner)
+        new = plan.new_record('org_node1', {'chef_environment': 'prod'},
+                              m.interner)
+        self.assertEqual(m.check_for_updates_in_metadata(current),
+                         {'chef_roles': 'db', 'chef_tags': 'a'})
+        self.assertEqual(current['chef_roles'], 'db')
+        self.assertEqual(m.check_for_updates_in_metadata(new),
+                         {'chefUniqueId': 'org_node1',
+                          'chef_environment': 'prod'})
+        m.state.close()
+
+    def test_multiple_organizations(self):
+        """
+        Check if every organization is swept with its own Chef API and
+        state file, sharing the SignalFx connections and ObjectID cache
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config_file = os.path.join(directory, 'configuration.txt')
+        with open(config_file, 'w') as f:
+            f.write('roles\n')
+
+        class FakeChefAPI(object):
+            def __init__(self, organization):
+                self.organization = organization
+
+            @classmethod
+            def from_config_file(cls, path):
+                return cls(os.path.basename(path).split('.')[0])
+
+            def api_request(self, method, path, data=None):
+                if path == '':
+                    return {'name': self.organization}
+                return {}
+
+        chef_api = collect_chef_metadata.ChefAPI
+        collect_chef_metadata.ChefAPI = FakeChefAPI
+        self.addCleanup(setattr, collect_chef_metadata, 'ChefAPI', chef_api)
+        m = collect_chef_metadata.MultiOrgChefMetadata(
+            ['/etc/chef/acme.rb', '/etc/chef/globex.rb'],
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            CONFIG_FILE=config_file,
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        acme, globex = m.collectors
+        self.assertEqual(globex.STATE_FILE,
+                         os.path.join(directory, 'state.globex.db'))
+        self.assertTrue(acme.signalfx.session is globex.signalfx.session)
+        self.assertTrue(acme.objectids is globex.objectids)
+        m.run()
+        self.assertEqual(acme.organization, 'acme')
+        self.assertEqual(globex.organization, 'globex')
+        self.assertTrue(os.path.exists(
+            os.path.join(directory, 'state.acme.db')))
+        active = []
+        overlaps = []
+
+        def run_sweep(collector):
+            def run():
+                active.append(collector)
+                overlaps.append(len(active))
+                time.sleep(0.05)
+                active.remove(collector)
+            return run
+
+        for collector in m.collectors:
+            collector.PROFILE = os.path.join(
+                directory, 'run.' + collector.organization + '.prof')
+            collector.run_sweep = run_sweep(collector)
+        m.run()
+        self.assertEqual(overlaps, [1, 1])
+        self.assertTrue(os.path.exists(
+            os.path.join(directory, 'run.globex.prof')))
+        for collector in m.collectors:
+            collector.state.close()
+        m.objectids.store.close()
+
+    def test_run_scheduled_syncs_from_search_rows(self):
+        """
+        Check if the adaptive run mode syncs the due nodes from the rows of
+        the partial search, without downloading the node objects, and if a
+        converged node is synced again in the next period
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            COLLECTION_MODE='partial-search',
+            INCREMENTAL=True,
+            SLEEP_DURATION=60,
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.config = ['roles']
+        m.read_config = lambda: None
+        ohai_times = dict(('node' + str(i), 1) for i in range(5))
+        requests_made = []
+
+        class FakeChefAPI(object):
+            def api_request(self, method, path, data=None):
+                requests_made.append((method, path.split('?')[0]))
+                if path == '':
+                    return {'name': 'org'}
+                rows = [{'data': {'name': node_name,
+                                  'chef_environment': 'prod',
+                                  'roles': ['web'],
+                                  'ohai_time': ohai_time}}
+                        for node_name, ohai_time
+                        in sorted(ohai_times.items())]
+                return {'total': len(rows), 'start': 0, 'rows': rows}
+
+        class FakeClock(object):
+            now = 1000.0
+
+            def __call__(self):
+                return self.now
+
+            def sleep(self, seconds):
+                self.now += seconds
+
+        clock = FakeClock()
+        real_sleep = collect_chef_metadata.sleep
+        collect_chef_metadata.sleep = clock.sleep
+        self.addCleanup(setattr, collect_chef_metadata, 'sleep', real_sleep)
+        synced = []
+
+        def send_updates_to_signalfx(updates, headers):
+            synced.extend(node_information['chefUniqueId']
+                          for node_information, new_metadata in updates)
+            return [True] * len(updates)
+
+        m.api = FakeChefAPI()
+        m.prefetch_signalfx_objectids = lambda unique_ids, headers: None
+        m.send_updates_to_signalfx = send_updates_to_signalfx
+        scheduler = collect_chef_metadata.AdaptiveScheduler(60, 600, clock)
+        m.run_scheduled(scheduler)
+        self.assertEqual(sorted(synced),
+                         ['org_node' + str(i) for i in range(5)])
+        self.assertEqual(m.state.get('org_node0'), {'chef_environment': 'prod',
+                                                    'chef_roles': 'web'})
+        m.state.commit([{'chefUniqueId': 'org_node1',
+                         'chef_environment': 'prod', 'chef_roles': 'db'}])
+        ohai_times['node1'] = 2
+        synced[:] = []
+        m.run_scheduled(scheduler)
+        self.assertEqual(synced, ['org_node1'])
+        self.assertEqual(set(method for method, path in requests_made),
+                         set(['GET', 'POST']))
+        self.assertEqual(set(path for method, path in requests_made),
+                         set(['', '/search/node']))
+        m.state.close()
+
+    def test_sync_notified_nodes(self):
+        """
+        Check if notifications of other organizations and shards are
+        refused and if a notified node is collected, sent and saved
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            SHARD_COUNT=2,
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.organization = 'org'
+        m.open_state_store()
+        node_names = [node_name for node_name in
+                      ['node' + str(i) for i in range(10)]
+                      if m.owns_node(node_name)]
+        self.assertFalse(m.accept_notification(node_names[0], 'other'))
+        self.assertEqual(sum(m.accept_notification('node' + str(i), None)
+                             for i in range(10)), len(node_names))
+        self.assertEqual(m.notifications.qsize(), len(node_names))
+        sent = []
+        m.fetch_node_information = lambda node_name: {
+            'chefUniqueId': 'org_' + node_name, 'chef_roles': 'web'}
+        m.send_metadata_to_signalfx = lambda node_information: \
+            sent.append(node_information) is None
+        m.sync_notified_node(node_names[0])
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(m.state.get('org_' + node_names[0]),
+                         {'chef_roles': 'web'})
+        m.state.close()
+
+    def test_bad_notifications_do_not_stop_syncing(self):
+        """
+        Check if a malformed notification is refused and if a node which
+        fails to sync does not keep the next notified node from syncing
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.organization = 'org'
+        m.open_state_store()
+        server = collect_chef_metadata.NotificationServer(
+            '127.0.0.1', 0, m.accept_notification, m.logger)
+        server.start()
+        self.addCleanup(server.stop)
+        url = 'http://127.0.0.1:' + str(server.port) + '/notify'
+        for body in ['{"node_name": 5}', '{"node_name": ["a"]}',
+                     '{"node_name": "a", "organization": 5}']:
+            self.assertEqual(requests.post(url, data=body).status_code, 400)
+        for node_name in ['bad', 'good']:
+            resp = requests.post(url, data=json.dumps(
+                {'node_name': node_name}))
+            self.assertEqual(resp.status_code, 202)
+        node_names = set()
+        while not m.notifications.empty():
+            node_names.add(m.notifications.get_nowait())
+        self.assertEqual(node_names, set(['bad', 'good']))
+        m.fetch_node_information = lambda node_name: {
+            'chefUniqueId': 'org_' + node_name, 'chef_roles': 'web'}
+
+        def send_metadata_to_signalfx(node_information):
+            if node_information['chefUniqueId'] == 'org_bad':
+                raise KeyError('rs')
+            return True
+
+        m.send_metadata_to_signalfx = send_metadata_to_signalfx
+        m.sync_notified_nodes(node_names)
+        self.assertEqual(m.state.get('org_good'), {'chef_roles': 'web'})
+        self.assertEqual(m.state.get('org_bad'), None)
+        m.state.close()
+
+    def test_run_budgeted_resumes_after_cursor(self):
+        """
+        Check if a run stops once its time budget is spent and if the next
+        run starts after the last node synced, wrapping around
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            TIME_BUDGET=2,
+            OBJECTID_BATCH_SIZE=3,
+            STATE_FILE=os.path.join(directory, 'state.db'),
+            PICKLE_FILE=os.path.join(directory, 'pk_metadata.pk'))
+        m.read_config = lambda: None
+
+        class FakeChefAPI(object):
+            def api_request(self, method, path, data=None):
+                if path == '':
+                    return {'name': 'org'}
+                return dict(('node' + str(i), '') for i in range(10))
+
+        class FakeTime(object):
+            now = 0
+
+            def time(self):
+                return self.now
+
+        fake_time = FakeTime()
+        real_time = collect_chef_metadata.time
+        collect_chef_metadata.time = fake_time
+        self.addCleanup(setattr, collect_chef_metadata, 'time', real_time)
+        chunks = []
+
+        def sync_nodes(node_names):
+            chunks.append(node_names)
+            fake_time.now += 1
+
+        m.api = FakeChefAPI()
+        m.sync_nodes = sync_nodes
+        m.run_budgeted()
+        self.assertEqual(chunks, [['node0', 'node1', 'node2'],
+                                  ['node3', 'node4', 'node5']])
+        self.assertEqual(m.state.get_cursor('sweep'), 'node5')
+        chunks[:] = []
+        m.run_budgeted()
+        self.assertEqual(chunks, [['node6', 'node7', 'node8'],
+                                  ['node9', 'node0', 'node1']])
+        m.state.close()
+
+    def test_run_profiled_writes_profile_and_report(self):
+        """
+        Check if a profiled run writes a cProfile file and logs and prints
+        a report of the nodes it timed
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profile_file = os.path.join(directory, 'run.prof')
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            PROFILE=profile_file,
+            PROFILE_TOP=2)
+        reports = []
+        m.logger.info = reports.append
+        self.addCleanup(delattr, m.logger, 'info')
+
+        def run_batch():
+            with m.profiler.call('chef GET /nodes/<name>', 'org_node1'):
+                pass
+            m.profiler.record_size('org_node1', {'roles': ['web']})
+
+        class FakeStdout(object):
+            def __init__(self):
+                self.text = ''
+
+            def write(self, text):
+                self.text += text
+
+        m.run_batch = run_batch
+        m.report_telemetry = lambda: None
+        real_stdout = sys.stdout
+        sys.stdout = FakeStdout()
+        try:
+            m.run()
+            printed = sys.stdout.text
+        finally:
+            sys.stdout = real_stdout
+        pstats.Stats(profile_file)
+        self.assertTrue('org_node1' in reports[-1])
+        self.assertTrue(profile_file in reports[-1])
+        self.assertTrue(printed.startswith('Slowest nodes'))
+        self.assertTrue('org_node1' in printed)
+
+    def test_read_config_only_when_modified(self):
+        """
+        Check if the configuration file is read and compiled again only
+        when its modification time changes
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config_file = os.path.join(directory, 'configuration.txt')
+        with open(config_file, 'w') as f:
+            f.write('# comment\nroles\nlanguages.python.version\n')
+        m = collect_chef_metadata.ChefMetadata(
+            SIGNALFX_API_TOKEN='dummy_signalfx_api_token',
+            LOG_HANDLER='stdout',
+            CONFIG_FILE=config_file)
+        m.read_config()
+        self.assertEqual(m.config, ['roles', 'languages.python.version'])
+        plan = m.extraction_plan
+        self.assertEqual(plan.targets[1],
+                         ('languages.python.version',
+                          'chef_languages_python_version'))
+        m.read_config()
+        self.assertTrue(m.get_extraction_plan() is plan)
+        with open(config_file, 'w') as f:
+            f.write('tags\n')
+        os.utime(config_file, (0, m.config_mtime + 1))
+        m.read_config()
+        self.assertEqual(m.config, ['tags'])
+        self.assertFalse(m.get_extraction_plan() is plan)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from node_metadata import ExtractionPlan, ValueInterner
+
+
+class CountingDict(dict):
+    """
+    Dictionary counting the lookups of its keys
+    """
+    lookups = []
+
+    def __getitem__(self, key):
+        CountingDict.lookups.append(key)
+        value = dict.__getitem__(self, key)
+        if isinstance(value, dict):
+            return CountingDict(value)
+        return value
+
+
+class Test_node_metadata(unittest.TestCase):
+
+    def test_extraction_plan(self):
+        """
+        Check if the plan finds every attribute with its property name,
+        walks shared prefixes once and reports the missing attributes
+        """
+        plan = ExtractionPlan(['languages.python.version',
+                               'languages.ruby.version',
+                               'languages.python',
+                               'kernel.name',
+                               'roles'],
+                              lambda attribute: 'chef_' +
+                              attribute.replace('.', '_'))
+        node_details = CountingDict({
+            'languages': {'python': {'version': '2.7.8'},
+                          'ruby': {'version': '2.1.0'}},
+            'roles': ['web'],
+        })
+        CountingDict.lookups = []
+        missing = []
+        found = plan.extract(node_details, missing)
+        self.assertEqual(
+            sorted((property_name, value)
+                   for attribute, property_name, value in found
+                   if attribute != 'languages.python'),
+            [('chef_languages_python_version', '2.7.8'),
+             ('chef_languages_ruby_version', '2.1.0'),
+             ('chef_roles', ['web'])])
+        self.assertIn('chef_languages_python',
+                      [property_name for attribute, property_name, value
+                       in found])
+        self.assertEqual(missing, ['kernel.name'])
+        self.assertEqual(CountingDict.lookups.count('languages'), 1)
+        self.assertEqual(CountingDict.lookups.count('python'), 1)
+        self.assertEqual([target[1] for target in plan.targets][:2],
+                         ['chef_languages_python_version',
+                          'chef_languages_ruby_version'])
+
+    def test_node_record(self):
+        """
+        Check if a node record reads like the dictionary it replaces and
+        if equal values are shared between records
+        """
+        plan = ExtractionPlan(['roles', 'tags', 'chef_tags'],
+                              lambda attribute: 'chef_' +
+                              attribute.replace('chef_', ''))
+        interner = ValueInterner()
+        first = plan.new_record('org_node0',
+                                {'chef_environment': 'prod',
+                                 'chef_roles': 'web$db'}, interner)
+        second = plan.new_record('org_node1',
+                                 {'chef_environment': 'prod',
+                                  'chef_roles': ''.join(['web$', 'db']),
+                                  'chef_tags': 'a'}, interner)
+        self.assertEqual(dict(first.items()),
+                         {'chefUniqueId': 'org_node0',
+                          'chef_environment': 'prod',
+                          'chef_roles': 'web$db'})
+        self.assertEqual(first, {'chefUniqueId': 'org_node0',
+                                 'chef_environment': 'prod',
+                                 'chef_roles': 'web$db'})
+        self.assertEqual(second['chef_tags'], 'a')
+        self.assertFalse(first == None)  # noqa: E711
+        self.assertTrue(first != None)  # noqa: E711
+        self.assertFalse(first in [None, 1])
+        self.assertTrue(first in [None, second, first])
+        self.assertNotEqual(first, second)
+        self.assertFalse('chef_tags' in first)
+        self.assertRaises(KeyError, lambda: first['chef_tags'])
+        self.assertEqual(plan.record_names,
+                         ('chef_environment', 'chef_roles', 'chef_tags'))
+        self.assertTrue(first['chef_roles'] is second['chef_roles'])
+        self.assertFalse(hasattr(first, '__dict__'))
+
+
+if __name__ == '__main__':
+    unittest.main()
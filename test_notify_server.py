@@ -0,0 +1,62 @@
+import unittest
+import json
+import logging
+import requests
+from notify_server import NotificationServer
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+
+class Test_notify_server(unittest.TestCase):
+
+    def test_notifications(self):
+        """
+        Check if node names are read from the path or the JSON body and
+        passed to the callback, and if invalid notifications are rejected
+        """
+        notified = []
+
+        def callback(node_name, organization):
+            notified.append((node_name, organization))
+            return organization != 'other'
+
+        server = NotificationServer('127.0.0.1', 0, callback,
+                                    logging.getLogger(__name__))
+        server.start()
+        self.addCleanup(server.stop)
+        url = 'http://127.0.0.1:' + str(server.port)
+        resp = requests.post(url + '/nodes/web%2F1?organization=acme')
+        self.assertEqual(resp.status_code, 202)
+        resp = requests.post(url + '/notify', data=json.dumps(
+            {'node_name': 'db1', 'organization_name': 'acme'}))
+        self.assertEqual(resp.status_code, 202)
+        resp = requests.post(url + '/notify', data=json.dumps(
+            {'node': 'db2', 'organization': 'other'}))
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(notified, [('web/1', 'acme'), ('db1', 'acme'),
+                                    ('db2', 'other')])
+        self.assertEqual(requests.post(url + '/notify',
+                                       data='{').status_code, 400)
+        self.assertEqual(requests.post(url + '/notify',
+                                       data='{}').status_code, 400)
+        self.assertEqual(requests.post(url + '/notify', data=json.dumps(
+            {'node_name': 5})).status_code, 400)
+        self.assertEqual(requests.post(url + '/notify', data=json.dumps(
+            {'node_name': 'db3', 'organization': ['acme']})).status_code,
+            400)
+        self.assertEqual(requests.post(url + '/other').status_code, 404)
+        self.assertEqual(len(notified), 3)
+        for content_length in ('abc', '-1'):
+            connection = HTTPConnection('127.0.0.1', server.port, timeout=5)
+            connection.putrequest('POST', '/nodes/web2')
+            connection.putheader('Content-Length', content_length)
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, 400)
+            connection.close()
+        self.assertEqual(len(notified), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
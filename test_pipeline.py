@@ -0,0 +1,62 @@
+import unittest
+import logging
+from pipeline import Pipeline, Stage
+
+
+class Test_pipeline(unittest.TestCase):
+
+    def test_items_flow_through_all_stages(self):
+        """
+        Check if every item goes through every stage, with several workers
+        and batches, and if an item raising an error is dropped
+        """
+        batches = []
+        results = []
+
+        def double(item, emit):
+            if item == 13:
+                raise ValueError(item)
+            emit(item * 2)
+
+        def batch(items, emit):
+            batches.append(len(items))
+            for item in items:
+                emit(item)
+
+        pipeline = Pipeline([
+            Stage('double', double, workers=4),
+            Stage('batch', batch, batch_size=10),
+            Stage('collect', lambda item, emit: results.append(item)),
+        ], logging.getLogger(__name__), queue_size=5)
+        pipeline.run(range(100))
+        self.assertEqual(sorted(results),
+                         [i * 2 for i in range(100) if i != 13])
+        self.assertTrue(max(batches) <= 10)
+        self.assertEqual(sum(batches), 99)
+
+    def test_empty_input(self):
+        """
+        Check if the pipeline ends when there are no items
+        """
+        results = []
+        pipeline = Pipeline([
+            Stage('first', lambda item, emit: emit(item), workers=2),
+            Stage('second', lambda items, emit: results.extend(items),
+                  batch_size=10),
+        ], logging.getLogger(__name__))
+        pipeline.run([])
+        self.assertEqual(results, [])
+
+    def test_stage_without_workers(self):
+        """
+        Check if a stage without workers, which would never consume its
+        queue, is refused
+        """
+        self.assertRaises(ValueError, Stage, 'none',
+                          lambda item, emit: emit(item), workers=0)
+        self.assertRaises(ValueError, Stage, 'empty',
+                          lambda items, emit: None, batch_size=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from profiler import NodeProfiler
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_profiler(unittest.TestCase):
+
+    def test_keeps_slowest_calls_and_nodes(self):
+        """
+        Check if only the slowest calls are kept and if the time of the
+        calls of each node is summed
+        """
+        clock = FakeClock()
+        profiler = NodeProfiler(top=2, clock=clock)
+        for seconds, kind, node_name in [(1, 'chef GET', 'a'),
+                                         (3, 'signalfx PATCH', 'a'),
+                                         (2, 'chef GET', 'b'),
+                                         (0.5, 'chef POST', None)]:
+            with profiler.call(kind, node_name):
+                clock.now += seconds
+        self.assertEqual(sorted(profiler.slowest_calls, reverse=True),
+                         [(3, 'signalfx PATCH', 'a'), (2, 'chef GET', 'b')])
+        self.assertEqual(profiler.node_seconds, {'a': 4, 'b': 2})
+        report = profiler.report().splitlines()
+        self.assertEqual(report[1].split(), ['4.000', 'a'])
+        self.assertEqual(report[4].split(), ['3.000', 'signalfx', 'PATCH',
+                                             'a'])
+
+    def test_record_size_of_nested_mappings(self):
+        """
+        Check if nodes are ranked by their size as JSON and if a disabled
+        profiler records nothing
+        """
+        class Attributes(Mapping):
+            # like the NodeAttributes of PyChef, not a dictionary
+            def __init__(self, **values):
+                self.values = values
+
+            def __getitem__(self, key):
+                return self.values[key]
+
+            def __iter__(self):
+                return iter(self.values)
+
+            def __len__(self):
+                return len(self.values)
+
+        profiler = NodeProfiler(top=1)
+        profiler.record_size('small', {'roles': ['web']})
+        profiler.record_size('large', Attributes(
+            languages=Attributes(python={'version': '2.7.18'})))
+        self.assertEqual(profiler.largest_nodes[0][1], 'large')
+        disabled = NodeProfiler(enabled=False)
+        with disabled.call('chef GET', 'a'):
+            pass
+        disabled.record_size('a', {})
+        self.assertEqual(disabled.slowest_calls, [])
+        self.assertEqual(disabled.largest_nodes, [])
+        self.assertEqual(disabled.node_seconds, {})
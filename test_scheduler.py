@@ -0,0 +1,59 @@
+import unittest
+from scheduler import AdaptiveScheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_scheduler(unittest.TestCase):
+
+    def test_new_nodes_are_spread(self):
+        """
+        Check if new nodes are due within the minimum interval and not
+        all at once
+        """
+        clock = FakeClock()
+        scheduler = AdaptiveScheduler(60, 3600, clock=clock)
+        scheduler.update(['node' + str(i) for i in range(100)])
+        self.assertTrue(len(scheduler.pop_due(1000)) < 50)
+        clock.now += 60
+        self.assertTrue(len(scheduler.pop_due(1000)) > 50)
+        self.assertEqual(scheduler.pop_due(1000), [])
+
+    def test_backoff_and_converged_nodes(self):
+        """
+        Check if a stable node backs off up to the maximum interval, a
+        changed node comes back after the minimum interval, a converged
+        node is due at once, a node whose sync failed is due again and a
+        removed node is forgotten
+        """
+        clock = FakeClock()
+        scheduler = AdaptiveScheduler(60, 300, clock=clock)
+        scheduler.update(['stable', 'busy'])
+        clock.now += 60
+        self.assertEqual(sorted(scheduler.pop_due(10)), ['busy', 'stable'])
+        delays = []
+        for i in range(4):
+            scheduler.reschedule('stable', False)
+            delays.append(scheduler.due['stable'] - clock.now)
+            clock.now = scheduler.due['stable']
+            self.assertEqual(scheduler.pop_due(10), ['stable'])
+        self.assertTrue(90 <= delays[0] <= 150)
+        self.assertTrue(225 <= delays[3] <= 375)
+        scheduler.reschedule('busy', True)
+        self.assertTrue(scheduler.due['busy'] - clock.now <= 75)
+        scheduler.reschedule('stable', False)
+        scheduler.update(['stable', 'busy'], converged=['stable'])
+        self.assertEqual(scheduler.pop_due(10), ['stable'])
+        scheduler.update(['stable'])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.next_due(), clock.now)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from sharding import jump_consistent_hash, shard_of
+
+
+class Test_sharding(unittest.TestCase):
+
+    def test_jump_consistent_hash(self):
+        """
+        Check if the buckets are in range and if adding a bucket only moves
+        keys to the new bucket
+        """
+        for key in range(1000):
+            bucket = jump_consistent_hash(key, 7)
+            self.assertTrue(0 <= bucket < 7)
+            moved = jump_consistent_hash(key, 8)
+            self.assertTrue(moved in (bucket, 7))
+        self.assertEqual(jump_consistent_hash(12345, 1), 0)
+
+    def test_shard_of_is_balanced_and_stable(self):
+        """
+        Check if node names are spread evenly and if going from 4 to 5
+        shards moves about a fifth of them
+        """
+        names = ['node' + str(i) for i in range(10000)]
+        counts = [0] * 4
+        for name in names:
+            counts[shard_of(name, 4)] += 1
+        self.assertTrue(min(counts) > 2200)
+        moved = sum(1 for name in names
+                    if shard_of(name, 4) != shard_of(name, 5))
+        self.assertTrue(1600 < moved < 2400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import requests
+from signalfx_client import SignalFxClient, SignalFxError, TokenBucket
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers, **kwargs):
+        self.requests.append((method, url, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class Test_signalfx_client(unittest.TestCase):
+
+    def get_client(self, responses, max_retries=3):
+        sleeps = []
+        client = SignalFxClient('dummy_signalfx_api_token',
+                                max_retries=max_retries,
+                                sleep=sleeps.append)
+        client.session = FakeSession(responses)
+        return client, sleeps
+
+    def test_retries_server_errors(self):
+        """
+        Check if connection errors and 5xx responses are retried with a
+        backoff, the token is sent with every request and every attempt
+        is observed
+        """
+        client, sleeps = self.get_client([
+            requests.ConnectionError('reset'),
+            FakeResponse(503),
+            FakeResponse(200)])
+        observed = []
+        client.observer = lambda method, url, seconds: observed.append(method)
+        resp = client.get('https://api.signalfx.com/v1/dimension')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(0 <= sleeps[1] <= client.backoff * 2)
+        self.assertEqual(client.session.requests[0][2]['X-SF-Token'],
+                         'dummy_signalfx_api_token')
+        self.assertEqual(observed, ['GET', 'GET', 'GET'])
+
+    def test_honors_retry_after(self):
+        """
+        Check if the Retry-After header of a 429 response is used as the
+        delay and if 4xx responses are returned without retrying
+        """
+        client, sleeps = self.get_client([
+            FakeResponse(429, {'Retry-After': '7'}),
+            FakeResponse(404)])
+        resp = client.patch('https://api.signalfx.com/v1/dimension/ABC')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(sleeps, [7.0])
+
+    def test_raises_after_max_retries(self):
+        """
+        Check if SignalFxError is raised once the retries are exhausted
+        """
+        client, sleeps = self.get_client([FakeResponse(500)] * 3,
+                                         max_retries=2)
+        self.assertRaises(SignalFxError, client.get,
+                          'https://api.signalfx.com/v1/dimension')
+        self.assertEqual(len(sleeps), 2)
+
+    def test_token_bucket(self):
+        """
+        Check if the token bucket allows a burst and then limits the rate
+        """
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0],
+                             sleep=sleep)
+        for i in range(4):
+            bucket.acquire()
+        self.assertEqual(sleeps, [0.5, 0.5])
+        bucket.pause(3)
+        bucket.acquire()
+        self.assertEqual(sleeps[-1], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
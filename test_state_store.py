@@ -0,0 +1,144 @@
+import unittest
+import os
+import pickle
+import shutil
+import tempfile
+from state_store import ObjectIdCache, RunLock, StateStore
+
+
+class Test_state_store(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.db')
+        self.store = StateStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_commit_writes_only_changed_nodes(self):
+        """
+        Check if the nodes are saved without their chefUniqueId and if only
+        the changed nodes are written again
+        """
+        nodes_metadata = [
+            {'chefUniqueId': 'org_node1', 'chef_environment': 'prod'},
+            {'chefUniqueId': 'org_node2', 'chef_environment': 'dev'},
+        ]
+        self.assertEqual(self.store.commit(nodes_metadata), 2)
+        self.assertEqual(self.store.get('org_node1'),
+                         {'chef_environment': 'prod'})
+        self.assertEqual(self.store.get('org_node3'), None)
+        self.assertIn('chefUniqueId', nodes_metadata[0])
+
+        nodes_metadata[1]['chef_environment'] = 'prod'
+        self.assertEqual(self.store.commit(nodes_metadata), 1)
+        self.assertEqual(self.store.get('org_node2'),
+                         {'chef_environment': 'prod'})
+
+    def test_state_persists_and_deletes(self):
+        """
+        Check if the saved state is read back by a new store and if deleted
+        nodes are removed
+        """
+        self.store.commit([{'chefUniqueId': 'org_node1', 'tags': 'a'},
+                           {'chefUniqueId': 'org_node2', 'tags': 'b'}])
+        self.store.delete(['org_node2'])
+        self.store.close()
+        self.store = StateStore(self.path)
+        self.assertEqual(self.store.unique_ids(), set(['org_node1']))
+
+    def test_cursor(self):
+        """
+        Check if a cursor is saved, read back by a new store and forgotten
+        """
+        self.assertEqual(self.store.get_cursor('sweep'), None)
+        self.store.set_cursor('sweep', 'node5')
+        self.store.close()
+        self.store = StateStore(self.path)
+        self.assertEqual(self.store.get_cursor('sweep'), 'node5')
+        self.store.set_cursor('sweep', None)
+        self.assertEqual(self.store.get_cursor('sweep'), None)
+
+    def test_run_lock(self):
+        """
+        Check if the lock is refused while it is held and granted once it
+        is released
+        """
+        lock = RunLock(self.path + '.lock')
+        other = RunLock(self.path + '.lock')
+        self.assertTrue(lock.acquire())
+        self.assertFalse(other.acquire())
+        lock.release()
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_commit_fingerprints(self):
+        """
+        Check if fingerprints are saved with the metadata and kept when a
+        node is committed without one
+        """
+        node_information = {'chefUniqueId': 'org_node1', 'tags': 'a'}
+        self.store.commit([node_information], {'org_node1': 'f1'})
+        self.assertEqual(self.store.commit([node_information],
+                                           {'org_node1': 'f1'}), 0)
+        self.assertEqual(self.store.commit([node_information],
+                                           {'org_node1': 'f2'}), 1)
+        self.store.commit([node_information])
+        self.assertEqual(self.store.fingerprints(), {'org_node1': 'f2'})
+
+    def test_import_pickle(self):
+        """
+        Check if the pickle file of earlier versions is imported only into
+        an empty store
+        """
+        pickle_file = os.path.join(self.directory, 'pk_metadata.pk')
+        with open(pickle_file, 'wb') as output:
+            pickle.dump({'org_node1': {'chef_environment': 'prod'}}, output)
+        self.assertEqual(self.store.import_pickle(pickle_file), 1)
+        self.assertEqual(self.store.get('org_node1'),
+                         {'chef_environment': 'prod'})
+        self.assertEqual(self.store.import_pickle(pickle_file), 0)
+
+    def test_objectid_cache_ttl(self):
+        """
+        Check if ObjectIDs expire after the TTL and missing dimensions
+        expire after the negative TTL
+        """
+        now = [1000.0]
+        cache = ObjectIdCache(self.store, ttl=100, negative_ttl=10,
+                              max_size=10, clock=lambda: now[0])
+        self.assertEqual(cache.lookup('org_node1'), (False, None))
+        cache.put('org_node1', 'ABC')
+        cache.put('org_node2', None)
+        self.assertEqual(cache.lookup('org_node1'), (True, 'ABC'))
+        self.assertEqual(cache.lookup('org_node2'), (True, None))
+        now[0] += 50
+        self.assertEqual(cache.lookup('org_node1'), (True, 'ABC'))
+        self.assertEqual(cache.lookup('org_node2'), (False, None))
+        cache.invalidate('org_node1')
+        self.assertEqual(cache.lookup('org_node1'), (False, None))
+
+    def test_objectid_cache_eviction(self):
+        """
+        Check if the flush evicts the oldest entries beyond max_size and
+        if the cache persists across stores
+        """
+        now = [1000.0]
+        cache = ObjectIdCache(self.store, ttl=100, negative_ttl=10,
+                              max_size=2, clock=lambda: now[0])
+        for i in range(3):
+            cache.put('org_node' + str(i), 'ID' + str(i))
+            now[0] += 1
+        cache.flush()
+        self.store.close()
+        self.store = StateStore(self.path)
+        cache = ObjectIdCache(self.store, ttl=100, negative_ttl=10,
+                              max_size=2, clock=lambda: now[0])
+        self.assertEqual(cache.lookup('org_node0'), (False, None))
+        self.assertEqual(cache.lookup('org_node2'), (True, 'ID2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from telemetry import LatencyHistogram, Telemetry
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_telemetry(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        """
+        Check if latencies are counted in the first bucket they fit in
+        """
+        histogram = LatencyHistogram()
+        for seconds in (0.005, 0.2, 0.2, 60):
+            histogram.observe(seconds)
+        result = histogram.to_dict()
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(result['max'], 60)
+        self.assertEqual(result['buckets']['0.01'], 1)
+        self.assertEqual(result['buckets']['0.25'], 2)
+        self.assertEqual(result['buckets']['+Inf'], 1)
+
+    def test_datapoints(self):
+        """
+        Check if the sweep, phases, counters and requests are exported as
+        gauges and counters, and if the lag is measured from the end of
+        the previous sweep
+        """
+        clock = FakeClock()
+        telemetry = Telemetry({'organization': 'org'}, clock=clock)
+        telemetry.start_sweep()
+        clock.now += 10
+        telemetry.end_sweep()
+        clock.now += 50
+        telemetry.start_sweep()
+        with telemetry.phase('collect'):
+            clock.now += 3
+        telemetry.increment('nodes.changed', 2)
+        telemetry.observe_request('chef GET /nodes', 0.3)
+        telemetry.end_sweep()
+        datapoints = telemetry.datapoints()
+        gauges = dict((datapoint['metric'], datapoint)
+                      for datapoint in datapoints['gauge'])
+        counters = dict((datapoint['metric'], datapoint)
+                        for datapoint in datapoints['counter']
+                        if 'le' not in datapoint['dimensions'])
+        self.assertEqual(gauges['chef_metadata.sweep.duration']['value'], 3)
+        self.assertEqual(gauges['chef_metadata.sweep.lag']['value'], 53)
+        self.assertEqual(gauges['chef_metadata.phase.duration']
+                         ['dimensions'],
+                         {'phase': 'collect', 'organization': 'org'})
+        self.assertEqual(counters['chef_metadata.nodes.changed']['value'], 2)
+        self.assertEqual(counters['chef_metadata.request.count']
+                         ['dimensions']['endpoint'], 'chef GET /nodes')
+        self.assertEqual(len(datapoints['counter']), 3 + 10)
+
+    def test_write_stats_file(self):
+        """
+        Check if the stats file holds the measurements of the sweep
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'stats.json')
+        telemetry = Telemetry()
+        telemetry.start_sweep()
+        with telemetry.request('chef GET /'):
+            pass
+        telemetry.end_sweep()
+        telemetry.write_stats_file(path)
+        with open(path) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['requests']['chef GET /']['count'], 1)
+        self.assertEqual(stats['sweep_lag'], None)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()